@@ -0,0 +1,240 @@
+"""
+Stitcher Benchmark
+
+Measures the stitcher on synthetic .sdt files (see synthetic_sdt.py), so performance can be tracked without game data.
+    file cases: for every file size and layout, parse MB/s of a file in memory (decode_sections), header scan MB/s
+                of a file on disk (scan_section_table), chunking time (SectionTable.get_chunks)
+                and stitch MB/s in the memory, stream and mmap stitch modes
+    tree cases: for every tree size, undubs a whole synthetic tree file by file and reports the throughput
+                and per-file latency percentiles
+Every case runs in a fresh child process, so its peak RSS is its own. The results are printed (or written) as JSON,
+so runs before and after a change can be compared.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import multiprocessing
+
+# the shared modules live in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from smart_file_undub import decode_sections, scan_section_table, smart_stitch, smart_stitch_to_file, smart_stitch_mapped
+from synthetic_sdt import LAYOUTS, write_synthetic_sdt, generate_corpus, parse_size
+
+try:
+    import resource
+except ImportError:
+    resource = None # Windows
+
+BENCHMARK_VERSION = 2 # 2: parsing and chunking are measured on SectionTables, as the stitcher uses them
+
+STITCH_MODES = ["memory", "stream", "mmap"]
+
+def get_peak_rss():
+    """
+    Peak resident set size of this process in bytes, or None where the platform does not report it
+    """
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+def get_mb_per_s(n_bytes, seconds):
+    if seconds <= 0:
+        return None
+    return round(n_bytes / seconds / (1024 * 1024), 2)
+
+def get_percentile(values, percentile):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * percentile / 100))]
+
+def time_best(function, repeat):
+    """
+    Best wall time of repeat calls of function
+    """
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        seconds = time.perf_counter() - start
+        if best is None or seconds < best:
+            best = seconds
+    return best
+
+def stitch_once(japanese_file, us_file, output_file, stitch_mode):
+    if stitch_mode == "memory":
+        output_data = smart_stitch(japanese_file, us_file)
+        with open(output_file, "wb") as output:
+            output.write(output_data)
+    elif stitch_mode == "stream":
+        with open(output_file, "wb") as output:
+            smart_stitch_to_file(japanese_file, us_file, output)
+    else:
+        with open(output_file, "wb") as output:
+            smart_stitch_mapped(japanese_file, us_file, output)
+
+def run_file_case(case):
+    """
+    Child process side of a file case: parses, scans, chunks and stitches one Japanese/US pair
+    """
+    japanese_file, us_file, output_file, measure, repeat = case
+    n_bytes = os.path.getsize(us_file) + os.path.getsize(japanese_file)
+
+    result = {}
+    if measure == "parse":
+        with open(us_file, "rb") as file:
+            data = file.read()
+        seconds = time_best(lambda: decode_sections(data), repeat)
+        result["parse_mb_per_s"] = get_mb_per_s(len(data), seconds)
+        result["parse_seconds"] = seconds
+    elif measure == "scan":
+        seconds = time_best(lambda: scan_section_table(us_file), repeat)
+        result["scan_mb_per_s"] = get_mb_per_s(os.path.getsize(us_file), seconds)
+        result["scan_seconds"] = seconds
+    elif measure == "chunk":
+        table = scan_section_table(us_file)
+        seconds = time_best(table.get_chunks, repeat)
+        result["n_sections"] = len(table)
+        result["chunk_seconds"] = seconds
+    else:
+        seconds = time_best(lambda: stitch_once(japanese_file, us_file, output_file, measure), repeat)
+        result["stitch_mb_per_s"] = get_mb_per_s(n_bytes, seconds)
+        result["stitch_seconds"] = seconds
+        os.remove(output_file)
+
+    result["peak_rss"] = get_peak_rss()
+    return result
+
+def run_tree_case(case):
+    """
+    Child process side of a tree case: undubs every file of a synthetic tree, one at a time
+    """
+    corpus_root, output_root, stitch_mode = case
+    from main import undub_file
+
+    latencies = []
+    n_bytes = 0
+    us_root = os.path.join(corpus_root, "us")
+    start = time.perf_counter()
+    for dir_path, dir_names, file_names in os.walk(us_root):
+        relative_folder = os.path.relpath(dir_path, us_root)
+        output_folder = os.path.join(output_root, relative_folder)
+        os.makedirs(output_folder, exist_ok=True)
+
+        for file in sorted(file_names):
+            us_file = os.path.join(dir_path, file)
+            japanese_file = os.path.join(corpus_root, "jp", relative_folder, file)
+            n_bytes += os.path.getsize(us_file) + os.path.getsize(japanese_file)
+
+            file_start = time.perf_counter()
+            undub_file(japanese_file, us_file, os.path.join(output_folder, file), stitch_mode)
+            latencies.append(time.perf_counter() - file_start)
+    seconds = time.perf_counter() - start
+
+    return {
+        "n_files": len(latencies),
+        "n_bytes": n_bytes,
+        "seconds": seconds,
+        "mb_per_s": get_mb_per_s(n_bytes, seconds),
+        "latency_p50": get_percentile(latencies, 50),
+        "latency_p95": get_percentile(latencies, 95),
+        "latency_max": max(latencies) if latencies else None,
+        "peak_rss": get_peak_rss(),
+    }
+
+def run_in_child(function, case):
+    """
+    Runs one case in a fresh process, so peak RSS is measured for that case alone
+    """
+    with multiprocessing.Pool(1, maxtasksperchild=1) as pool:
+        return pool.apply(function, (case,))
+
+def run_benchmark(work_folder, file_sizes, tree_sizes, layouts, repeat=3, seed=0):
+    results = {
+        "version": BENCHMARK_VERSION,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "repeat": repeat,
+        "file_cases": [],
+        "tree_cases": [],
+    }
+
+    for layout in layouts:
+        for size in file_sizes:
+            us_file = os.path.join(work_folder, "files", f"{layout}_{size}_us.sdt")
+            japanese_file = os.path.join(work_folder, "files", f"{layout}_{size}_jp.sdt")
+            output_file = os.path.join(work_folder, "files", f"{layout}_{size}_out.sdt")
+            write_synthetic_sdt(us_file, layout, size, seed, audio_seed=seed + 1)
+            write_synthetic_sdt(japanese_file, layout, size, seed, audio_seed=seed + 2)
+
+            case_result = {"layout": layout, "size": os.path.getsize(us_file)}
+            for measure in ["parse", "scan", "chunk"] + STITCH_MODES:
+                measure_result = run_in_child(run_file_case, (japanese_file, us_file, output_file, measure, repeat))
+                peak_rss = measure_result.pop("peak_rss")
+                if measure in STITCH_MODES:
+                    case_result[measure] = measure_result
+                    measure_result["peak_rss"] = peak_rss
+                else:
+                    case_result.update(measure_result)
+                    case_result[f"{measure}_peak_rss"] = peak_rss
+            print(f"\t{layout} {size} bytes: parse {case_result['parse_mb_per_s']} MB/s, scan {case_result['scan_mb_per_s']} MB/s", file=sys.stderr)
+
+            results["file_cases"].append(case_result)
+            os.remove(us_file)
+            os.remove(japanese_file)
+
+    for n_files in tree_sizes:
+        corpus_root = os.path.join(work_folder, f"tree_{n_files}")
+        generate_corpus(corpus_root, n_files, file_sizes, layouts, seed)
+
+        case_result = {"n_files": n_files}
+        for stitch_mode in STITCH_MODES:
+            output_root = os.path.join(corpus_root, f"output_{stitch_mode}")
+            case_result[stitch_mode] = run_in_child(run_tree_case, (corpus_root, output_root, stitch_mode))
+            shutil.rmtree(output_root)
+        print(f"\ttree of {n_files} files: memory {case_result['memory']['mb_per_s']} MB/s", file=sys.stderr)
+
+        results["tree_cases"].append(case_result)
+        shutil.rmtree(corpus_root)
+
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the stitcher on synthetic .sdt files and prints the results as JSON")
+    parser.add_argument("--file-sizes", default="64K,1M,16M", help="comma separated file sizes (default: 64K,1M,16M)")
+    parser.add_argument("--tree-sizes", default="10,100", help="comma separated numbers of files per tree (default: 10,100)")
+    parser.add_argument("--layouts", default=",".join(LAYOUTS), help=f"comma separated layouts out of {', '.join(LAYOUTS)}")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per file measurement, the best is kept (default: 3)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--work-folder", help="where the synthetic files are written (default: a temporary folder)")
+    parser.add_argument("-o", "--output", help="write the JSON results to this file instead of printing them")
+    args = parser.parse_args()
+
+    file_sizes = [parse_size(size) for size in args.file_sizes.split(",")]
+    tree_sizes = [int(n_files) for n_files in args.tree_sizes.split(",") if n_files]
+    layouts = args.layouts.split(",")
+    for layout in layouts:
+        if layout not in LAYOUTS:
+            print(f"Unknown layout {layout}")
+            sys.exit(1)
+
+    work_folder = args.work_folder or tempfile.mkdtemp(prefix="sdt_benchmark_")
+    try:
+        results = run_benchmark(work_folder, file_sizes, tree_sizes, layouts, args.repeat, args.seed)
+    finally:
+        if args.work_folder is None:
+            shutil.rmtree(work_folder, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
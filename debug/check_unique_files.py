@@ -1,55 +1,175 @@
-# find unique files in twin directory structures
+# find unique, identical and different files in twin directory structures
 import os
-import sys
-import pathlib
-import numpy as np
-
-def find_unique_files(first_folder, second_folder):
-	first_folder = pathlib.Path(first_folder).absolute().__str__()
-	first_folder_name = pathlib.Path(first_folder).parts[-1]
-	
-	second_folder = pathlib.Path(second_folder).absolute().__str__()
-	second_folder_name = pathlib.Path(second_folder).parts[-1]
-	
-	unique_files = []
-	anime_titties = 0
-	
-	for dir_path, dir_names, files in os.walk(first_folder):
-		true_dir_path = pathlib.Path(dir_path).absolute()
-		index = true_dir_path.parts.index(first_folder_name) # find the index in which the us_folder occurs
-		sub_directories = "\\".join(true_dir_path.parts[index + 1:]) # copy all remaining subdirectory paths
-		
-		for file in files:
-			file_path = f"{second_folder}\\{sub_directories}\\{file}"
-			if not os.path.exists(file_path):
-				unique_files.append(f"{first_folder}\\{sub_directories}\\{file}")
-	
-	return unique_files
+import json
+import sqlite3
+import hashlib
+import argparse
+import concurrent.futures
 
+HASH_CHUNK_SIZE = 1024 * 1024 # bytes hashed at a time
+
+def index_tree(folder):
+	"""
+	Size and modification time of every file under folder, keyed by its path relative to folder with / separators.
+	Walks the tree in a single os.scandir pass: the listing tells files from folders without a stat call,
+	but the size and modification time still take one stat call per file (on Windows the listing holds them too)
+	"""
+	files = {}
+	pending = [("", folder)]
+	while pending:
+		relative_folder, dir_path = pending.pop()
+		with os.scandir(dir_path) as entries:
+			for entry in entries:
+				relative_path = f"{relative_folder}{entry.name}"
+				if entry.is_dir():
+					pending.append((f"{relative_path}/", entry.path))
+				elif entry.is_file():
+					stat = entry.stat()
+					files[relative_path] = (stat.st_size, stat.st_mtime_ns)
+	return files
+
+def hash_file(file_path):
+	"""
+	Content fingerprint of a file, hashed in chunks
+	"""
+	digest = hashlib.blake2b(digest_size=20)
+	with open(file_path, "rb") as file:
+		for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b""):
+			digest.update(chunk)
+	return digest.hexdigest()
+
+class FingerprintCache:
+	"""
+	Content fingerprints of files in a small SQLite database, keyed by absolute path, size and mtime,
+	so files that have not changed since they were last hashed are never read again
+	"""
+	def __init__(self, cache_path):
+		self.connection = sqlite3.connect(cache_path)
+		self.connection.execute(
+			"CREATE TABLE IF NOT EXISTS fingerprints (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, digest TEXT)"
+		)
+		self.connection.commit()
+
+	def get(self, file_path, size, mtime_ns):
+		row = self.connection.execute("SELECT size, mtime_ns, digest FROM fingerprints WHERE path = ?", (file_path,)).fetchone()
+		if row is not None and row[0] == size and row[1] == mtime_ns:
+			return row[2]
+		return None
+
+	def put(self, file_path, size, mtime_ns, digest):
+		self.connection.execute(
+			"INSERT OR REPLACE INTO fingerprints (path, size, mtime_ns, digest) VALUES (?, ?, ?, ?)",
+			(file_path, size, mtime_ns, digest)
+		)
+
+	def close(self):
+		self.connection.commit()
+		self.connection.close()
+
+def fingerprint_files(files, jobs=8, cache=None):
+	"""
+	Fingerprints of (file_path, size, mtime_ns) files, hashed on jobs threads (hashing releases the GIL)
+	and taken from cache (a FingerprintCache) where they have not changed. Returns {file_path: digest}
+	"""
+	digests = {}
+	to_hash = []
+	for file_path, size, mtime_ns in files:
+		digest = cache.get(file_path, size, mtime_ns) if cache is not None else None
+		if digest is None:
+			to_hash.append((file_path, size, mtime_ns))
+		else:
+			digests[file_path] = digest
+
+	with concurrent.futures.ThreadPoolExecutor(max(1, jobs)) as executor:
+		futures = {executor.submit(hash_file, file_path): (file_path, size, mtime_ns) for file_path, size, mtime_ns in to_hash}
+		for future in concurrent.futures.as_completed(futures):
+			file_path, size, mtime_ns = futures[future]
+			digests[file_path] = future.result()
+			if cache is not None:
+				cache.put(file_path, size, mtime_ns, digests[file_path])
+
+	print(f"Hashed {len(to_hash)} files, {len(files) - len(to_hash)} fingerprints were cached")
+	return digests
+
+def diff_trees(first_folder, second_folder, compare_contents=True, jobs=8, cache=None):
+	"""
+	Compares two twin directory structures file by file, by relative path.
+	Files in both trees are different if their sizes differ, otherwise their contents are compared
+	by fingerprint (unless compare_contents is False, in which case they count as identical).
+	Returns {"first_unique", "second_unique", "identical", "different"}: lists of relative paths,
+	the unique ones sorted by size
+	"""
+	first_folder = os.path.abspath(first_folder)
+	second_folder = os.path.abspath(second_folder)
+
+	first_files = index_tree(first_folder)
+	second_files = index_tree(second_folder)
+
+	first_unique = sorted((path for path in first_files if path not in second_files), key=lambda path: (first_files[path][0], path))
+	second_unique = sorted((path for path in second_files if path not in first_files), key=lambda path: (second_files[path][0], path))
+
+	identical = []
+	different = []
+	same_size = []
+	for path in sorted(path for path in first_files if path in second_files):
+		if not first_files[path][0] == second_files[path][0]:
+			different.append(path)
+		elif compare_contents:
+			same_size.append(path)
+		else:
+			identical.append(path)
+
+	if same_size:
+		files = []
+		for path in same_size:
+			for folder, tree in ((first_folder, first_files), (second_folder, second_files)):
+				files.append((os.path.join(folder, *path.split("/")), *tree[path]))
+
+		digests = fingerprint_files(files, jobs, cache)
+
+		for path in same_size:
+			native_path = os.path.join(*path.split("/"))
+			if digests[os.path.join(first_folder, native_path)] == digests[os.path.join(second_folder, native_path)]:
+				identical.append(path)
+			else:
+				different.append(path)
+		different.sort()
+
+	return {"first_unique": first_unique, "second_unique": second_unique, "identical": identical, "different": different}
 
 if __name__ == "__main__":
-	print("Usage:")
-	print("python check_unique_files.py first_folder second_folder")
-	
-	if not len(sys.argv) == 3:
-		print("Invalid Arugments provided. Check usage.")
-	
-	first_file_unique = find_unique_files(sys.argv[1], sys.argv[2])
-	first_file_sizes = [os.path.getsize(file_path) for file_path in first_file_unique]
-	print(first_file_unique)
-	print(np.argsort(first_file_sizes))
-	
-	first_file_unique = np.array(first_file_unique)[np.argsort(first_file_sizes)]
-	print(f"Files Exclusively found in the US Dub: {sys.argv[1]}")
-	print(first_file_unique)
-	print(f"Different Files: {len(first_file_unique)}")
-	
+	parser = argparse.ArgumentParser(description="Finds the unique, identical and different files of two twin directory structures (e.g. the extracted US and Japanese archives)")
+	parser.add_argument("first_folder")
+	parser.add_argument("second_folder")
+	parser.add_argument("-j", "--jobs", type=int, default=8, help="number of files hashed at once (default: 8)")
+	parser.add_argument("--cache", default=None, help="SQLite file caching file fingerprints between runs, so only changed files are hashed again")
+	parser.add_argument("--sizes-only", action="store_true", help="do not compare contents, files of the same size count as identical")
+	parser.add_argument("--json", default=None, help="also write the lists of files to this JSON file")
+	args = parser.parse_args()
+
+	cache = FingerprintCache(args.cache) if args.cache is not None else None
+	try:
+		diff = diff_trees(args.first_folder, args.second_folder, not args.sizes_only, args.jobs, cache)
+	finally:
+		if cache is not None:
+			cache.close()
+
+	print(f"Files Exclusively found in the US Dub: {args.first_folder}")
+	print(diff["first_unique"])
+	print(f"Different Files: {len(diff['first_unique'])}")
+
+	print()
+
+	print(f"Files Exclusively found in the Japanese Dub: {args.second_folder}")
+	print(diff["second_unique"])
+	print(f"Different Files: {len(diff['second_unique'])}")
+
 	print()
-	
-	second_file_unique = find_unique_files(sys.argv[2], sys.argv[1])
-	second_file_sizes = [os.path.getsize(file_path) for file_path in second_file_unique]
-	print(f"Files Exclusively found in the Japanese Dub: {sys.argv[2]}")
-	print(second_file_unique)
-	print(f"Different Files: {len(second_file_unique)}")
-	
-    
+
+	print("Files found in both with different contents:")
+	print(diff["different"])
+	print(f"Different Files: {len(diff['different'])}, Identical Files: {len(diff['identical'])}")
+
+	if args.json is not None:
+		with open(args.json, "w") as json_file:
+			json.dump(diff, json_file, indent=1)
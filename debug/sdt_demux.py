@@ -1,134 +1,236 @@
+"""
+SDT Demuxer
+
+Extracts every stream of .sdt files into their own files, next to the .sdt or mirrored into an output folder:
+    file.sdt -> file.m2v, file.msf, file.sub_en, ... (unknown streams as file_XXXXXXXX.bin)
+ADPCM streams (ID 1) get a GENH header so they can be played back.
+
+Pass folders to demux every .sdt in them across worker processes. Every file is planned from a header-only scan
+first, so each stream is then written front to back in one buffered pass, GENH header included.
+A summary index of everything extracted can be written as JSON with --index.
+"""
 import os
 import sys
-import struct
-
-def get_u32_le(buf, offset):
-    return struct.unpack("<I", buf[offset:offset+4])[0]
-
-def put_u32_le(buf, offset, n):
-    buf[offset:offset+4] = struct.pack("<I", n)
-
-extmap = {
-    0x00000001: ".genh",   # ADPCM -> GENH / ".sdx_0"
-    0x00000002: ".dmx",    # this container was found on Zone of the Enders HD Remaster
-	0x00000003: ".nrm",
-    0x00000004: ".pacb",   # has "PACB" magic not seen in any of the original versions the HD remaster was based on
-    0x00000005: ".dmx",    # ditto
-    0x00000006: ".bpx",    
-    0x0000000c: ".pac",    # XBOX version of MGS2 - MPEG2 video format
-    0x0000000d: ".pac",    # XBOX version of MGS2 - MPEG2 video format
-	0x0000000e: ".pss",    # PS2 version of MGS2 - MPEG2 video format
-	0x0000000f: ".ipu",    # PS2 version of MGS2 - MPEG2 video format
-    0x00000020: ".m2v",    # this container is present even on all versions of the HD remaster(PS3, XBOX360, PSVITA), regardless of format
-    0x00010001: ".sdx_1",
-	0x00010004: ".sub_en", # it's a made-up container, becuase in the executable of those Metal Gear Solid PS2 games there's no indication of a container used for these formats
-    0x00020001: ".sdx_2",
-	0x00020004: ".sub_fr", # ditto
-    0x00030001: ".msf",    # PS3 HD remaster audio format
-	0x00030004: ".sub_de", # ditto
-	0x00040001: ".xwma",   # XBOX360 HD remaster audio format
-	0x00040004: ".sub_it", # ditto
-	0x00050001: ".9tav",   # PSVITA HD remaster audio format
-	0x00050004: ".sub_es", # ditto
-	0x00060004: ".sub_jp", # ditto
-	0x00070004: ".sub_jp", # ditto
-    0x00100001: ".vag",    # VAG1/VAG2 format
-    0x00110001: ".mtaf",   # MTAF format
-
-    #0x00000002: ".xxxx",
-    #0x00000005: ".xxxx",
-    #0x00010006: ".xxxx",
-    #0x00020006: ".xxxx",
-    #0x00030006: ".xxxx",
-    #0x00040006: ".xxxx",
-    #0x00050006: ".xxxx",
-    #0x00070006: ".xxxx",
-}
+import json
+import argparse
+import traceback
+import multiprocessing
+
+# the shared modules live in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from sdt import put_u32_le, get_extension, get_stream_kind, scan_section_table
 
 STREAM_ID_ADPCM = 1
 
-streams = {
-}
-
-def main(argv=sys.argv, argc=len(sys.argv)):
-    if argc != 2:
-        print("Usage: %s <sdt>" % argv[0])
-        return 1
-
-    sdt_path = os.path.realpath(argv[1])
-
-    if not os.path.isfile(sdt_path):
-        print("invalid path")
-        return 1
-
-    with open(sdt_path, "rb") as sdt:
-        sdt_size = os.path.getsize(sdt_path)
-        while (sdt.tell() < sdt_size):
-            header = sdt.read(16) #read first 16 bytes
-            id = get_u32_le(header, 0x00) #unsigned 32-bit little-endian
-            if id == 0xF0: ##
-                # end of stream found
-                break
-            elif id == 0x10:
-                # register stream
-                sid = get_u32_le(header, 0x0C)
-
-                if sid in streams: #sid=stream id
-                    print("0x%08X: stream already registered once: %08X" % (sdt.tell() - 16, sid))
-                    return 1
-
-                if sid in extmap: #if it's a recognized stream
-                    path = "%s%s" % (os.path.splitext(sdt_path)[0], extmap[sid])
-                else: #if it's not, it's just a .bin
-                    path = "%s_%08X.bin" % (os.path.splitext(sdt_path)[0], sid)
-
-                streams[sid] = open(path, "w+b")
-
-                if sid == STREAM_ID_ADPCM:
-                    # reserve space for GENH header
-                    streams[sid].write(b"\0" * 4096)
-            elif id in streams:
-                size = get_u32_le(header, 0x04) - 16 ##-16, in order to not count the header
-                read_data = sdt.read(size)
-                # Field 0xC of the header is a sort of index, 0 is padding.
-                # It is also set to 0 for the first (non-padding) block.
-                # Only write the data if this is the first block,
-                # or field 0xC is nonzero. Otherwise, it's padding to drop.
-                if streams[id].tell() == 0 or get_u32_le(header, 0x0C) != 0:
-                    streams[id].write(read_data)
-            else:
-                print("0x%08X: unregistered stream / unknown header ID: %08X" % (sdt.tell() - 16, id))
-                return 1
-
-    # finalize GENH
-    if STREAM_ID_ADPCM in streams:
-        genh_size = streams[STREAM_ID_ADPCM].tell()
-
-        # get proprietary header data
-        streams[STREAM_ID_ADPCM].seek(4096)
-        header = streams[STREAM_ID_ADPCM].read(16)
-        sample_rate = (header[0x06] << 8) | header[0x07]
-        channels = header[8]
-
-        # fill in GENH header
-        streams[STREAM_ID_ADPCM].seek(0)
-        genh = bytearray(4096)
-        genh[0x00:0x04] = b"GENH"                                               # 0x00 magic
-        put_u32_le(genh, 0x04, channels)                                        # 0x04 channels
-        put_u32_le(genh, 0x08, 2048 if channels > 1 else 0)                     # 0x08 interleave
-        put_u32_le(genh, 0x0C, sample_rate)                                     # 0x0C sample rate
-        put_u32_le(genh, 0x10, 0xFFFFFFFF)                                      # 0x10 loop start
-        put_u32_le(genh, 0x14, (genh_size - 0x1010) // 16 * 28 // channels)     # 0x14 loop end
-        put_u32_le(genh, 0x18, 0)                                               # 0x18 coding
-        put_u32_le(genh, 0x1C, 0x1010)                                          # 0x1C audio start
-        put_u32_le(genh, 0x20, 0x1000)                                          # 0x20 header size
-        streams[STREAM_ID_ADPCM].write(genh)
-
-    # clean up
-    for stream in streams:
-        streams[stream].close()
-
-    return 0
+GENH_SIZE = 4096 # space reserved in front of ADPCM streams for the GENH header
+
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+
+def get_stream_path(output_base, stream_id, used_paths):
+    """
+    Output path of a stream: output_base plus the stream extension, or output_base_XXXXXXXX.bin for unknown streams.
+    Streams sharing an extension get their ID in the name as well, instead of overwriting each other
+    """
+    extension = get_extension(stream_id)
+    if extension == ".bin":
+        path = "%s_%08X.bin" % (output_base, stream_id)
+    else:
+        path = "%s%s" % (output_base, extension)
+
+    if path in used_paths:
+        path = "%s_%08X%s" % (output_base, stream_id, extension)
+
+    used_paths.add(path)
+    return path
+
+def build_genh(genh_size, first_block):
+    """
+    GENH header of an ADPCM stream of genh_size bytes (header included),
+    from the first 16 bytes of its data, the proprietary header
+    """
+    if len(first_block) < 9:
+        raise Exception("ADPCM stream is too short for its header")
+
+    sample_rate = (first_block[0x06] << 8) | first_block[0x07]
+    channels = first_block[8]
+
+    genh = bytearray(GENH_SIZE)
+    genh[0x00:0x04] = b"GENH"                                               # 0x00 magic
+    put_u32_le(genh, 0x04, channels)                                        # 0x04 channels
+    put_u32_le(genh, 0x08, 2048 if channels > 1 else 0)                     # 0x08 interleave
+    put_u32_le(genh, 0x0C, sample_rate)                                     # 0x0C sample rate
+    put_u32_le(genh, 0x10, 0xFFFFFFFF)                                      # 0x10 loop start
+    put_u32_le(genh, 0x14, (genh_size - 0x1010) // 16 * 28 // channels)     # 0x14 loop end
+    put_u32_le(genh, 0x18, 0)                                               # 0x18 coding
+    put_u32_le(genh, 0x1C, 0x1010)                                          # 0x1C audio start
+    put_u32_le(genh, 0x20, 0x1000)                                          # 0x20 header size
+    return genh
+
+def demux_sdt(sdt_path, output_base=None):
+    """
+    Writes every stream of a .sdt to its own file, named after output_base (by default the .sdt path without extension).
+    Returns a summary of the file: its streams with their paths, kinds, number of sections kept and dropped, and sizes
+    """
+    if output_base is None:
+        output_base = os.path.splitext(sdt_path)[0]
+
+    table = scan_section_table(sdt_path)
+
+    # plan: which sections of which streams are kept, and how big every stream ends up
+    streams = {}
+    used_paths = set()
+    for stream_id in table.streams:
+        streams[stream_id] = {
+            "stream_id": stream_id,
+            "extension": get_extension(stream_id),
+            "kind": get_stream_kind(stream_id),
+            "path": get_stream_path(output_base, stream_id, used_paths),
+            "n_sections": 0,
+            "n_dropped_sections": 0,
+            "size": GENH_SIZE if stream_id == STREAM_ID_ADPCM else 0,
+        }
+
+    kept_sections = []
+    for i, (header_id, block_index, length) in enumerate(zip(table.header_ids, table.stream_ids, table.lengths)):
+        if header_id == 0xF0:
+            # end of stream found
+            break
+        elif header_id == 0x10:
+            continue
+
+        stream = streams[header_id]
+        # Field 0xC of the header is a sort of index, 0 is padding.
+        # It is also set to 0 for the first (non-padding) block.
+        # Only keep the data if this is the first block,
+        # or field 0xC is nonzero. Otherwise, it's padding to drop.
+        # (ADPCM streams never start empty, the space for the GENH header comes first)
+        if stream["size"] == 0 or not block_index == 0:
+            kept_sections.append(i)
+            stream["n_sections"] += 1
+            stream["size"] += length - 16
+        else:
+            stream["n_dropped_sections"] += 1
+
+    # write every stream front to back
+    outputs = {}
+    try:
+        for stream_id, stream in streams.items():
+            outputs[stream_id] = open(stream["path"], "wb", buffering=OUTPUT_BUFFER_SIZE)
+
+        with open(sdt_path, "rb") as sdt:
+            if STREAM_ID_ADPCM in streams:
+                # the GENH header needs the proprietary header at the start of the ADPCM data
+                first_block = b""
+                for i in kept_sections:
+                    if len(first_block) >= 16:
+                        break
+                    if table.header_ids[i] == STREAM_ID_ADPCM:
+                        sdt.seek(table.offsets[i] + 16)
+                        first_block += sdt.read(min(table.lengths[i] - 16, 16 - len(first_block)))
+
+                outputs[STREAM_ID_ADPCM].write(build_genh(streams[STREAM_ID_ADPCM]["size"], first_block))
+
+            for i in kept_sections:
+                sdt.seek(table.offsets[i] + 16)
+                outputs[table.header_ids[i]].write(sdt.read(table.lengths[i] - 16))
+    finally:
+        for output in outputs.values():
+            output.close()
+
+    return {"sdt": sdt_path, "size": table.sdt_size, "streams": list(streams.values())}
+
+def find_sdt_files(paths):
+    """
+    The .sdt files among paths, with those inside folders found recursively, as (sdt_path, root) where root
+    is the folder the file was found in (or the file's own folder)
+    """
+    sdt_files = []
+    for path in paths:
+        path = os.path.realpath(path)
+        if os.path.isdir(path):
+            for dir_path, dir_names, file_names in os.walk(path):
+                dir_names.sort()
+                for file_name in sorted(file_names):
+                    if os.path.splitext(file_name)[-1] == ".sdt":
+                        sdt_files.append((os.path.join(dir_path, file_name), path))
+        else:
+            sdt_files.append((path, os.path.dirname(path)))
+    return sdt_files
+
+def demux_task(item):
+    """
+    Runs demux_sdt on one (sdt_path, output_base) item. Never raises, so it is safe to run in a worker process;
+    returns (sdt_path, summary or None, error traceback or None)
+    """
+    sdt_path, output_base = item
+    try:
+        return sdt_path, demux_sdt(sdt_path, output_base), None
+    except (Exception, SystemExit):
+        # the SDT parsers call exit() on malformed files, which would otherwise kill a pool worker
+        return sdt_path, None, traceback.format_exc()
+
+def demux_tree(paths, output_folder=None, jobs=1):
+    """
+    Demuxes every .sdt in paths (files or folders), across jobs worker processes.
+    With output_folder, the streams go to the same relative paths in it instead of next to the .sdt files.
+    Returns the summary index: every demuxed file, totals per extension and the files that failed
+    """
+    work = []
+    for sdt_path, root in find_sdt_files(paths):
+        if output_folder is None:
+            output_base = os.path.splitext(sdt_path)[0]
+        else:
+            output_base = os.path.join(output_folder, os.path.splitext(os.path.relpath(sdt_path, root))[0])
+            os.makedirs(os.path.dirname(output_base), exist_ok=True)
+        work.append((sdt_path, output_base))
+
+    files = []
+    failed = []
+    if jobs > 1:
+        with multiprocessing.Pool(jobs) as pool:
+            results = list(pool.imap_unordered(demux_task, work, chunksize=4))
+    else:
+        results = [demux_task(item) for item in work]
+
+    for sdt_path, summary, error in results:
+        if error is not None:
+            print(error)
+            print(f"Unable to demux {sdt_path}")
+            failed.append(sdt_path)
+        else:
+            files.append(summary)
+
+    files.sort(key=lambda summary: summary["sdt"])
+
+    totals = {}
+    for summary in files:
+        for stream in summary["streams"]:
+            total = totals.setdefault(stream["extension"], {"kind": stream["kind"], "n_streams": 0, "n_sections": 0, "size": 0})
+            total["n_streams"] += 1
+            total["n_sections"] += stream["n_sections"]
+            total["size"] += stream["size"]
+
+    return {"files": files, "totals": totals, "failed": sorted(failed)}
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(prog=os.path.basename(argv[0]), description="Extracts every stream of .sdt files, or of every .sdt in folders")
+    parser.add_argument("paths", nargs="+", help=".sdt files or folders to search for them")
+    parser.add_argument("-o", "--output", default=None, help="mirror the streams into this folder instead of writing them next to the .sdt files")
+    parser.add_argument("-j", "--jobs", type=int, default=multiprocessing.cpu_count(), help="number of worker processes (default: all cores)")
+    parser.add_argument("--index", default=None, metavar="JSON", help="write a summary index of every extracted stream to this file")
+    args = parser.parse_args(argv[1:])
+
+    index = demux_tree(args.paths, args.output, args.jobs)
+
+    for extension, total in sorted(index["totals"].items()):
+        print(f"\t{extension} ({total['kind']}): {total['n_streams']} streams, {total['n_sections']} sections, {total['size']} bytes")
+    print(f"Demuxed {len(index['files'])} files, {len(index['failed'])} failed")
+
+    if args.index is not None:
+        with open(args.index, "w") as index_file:
+            json.dump(index, index_file, indent=1)
+
+    return 1 if index["failed"] else 0
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,130 @@
+"""
+Synthetic SDT Generator
+
+Writes made-up .sdt files shaped like the real ones, so the stitcher can be measured without game data.
+Every file registers its streams with 0x10 headers, interleaves chunks of data sections from them
+and ends on an 0xF0 header. Four layouts mimic the game's folders:
+    vox:   a single .vag stream
+    radio: .dmx data, .vag audio and .bpx lip sync, interleaved
+    demo:  .m2v video, .msf audio, English subtitles and an unknown .bin stream
+    movie: long .m2v video chunks with .msf audio in between
+A Japanese/US pair shares the same layout (and so the same audio chunk counts) with different audio payloads.
+"""
+import io
+import os
+import sys
+import random
+import argparse
+
+# the shared modules live in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from sdt import SDTWriter
+
+STREAM_VAG = 0x00100001
+STREAM_MSF = 0x00030001
+STREAM_M2V = 0x00000020
+STREAM_DMX = 0x00000005
+STREAM_BPX = 0x00000006
+STREAM_SUB_EN = 0x00010004
+STREAM_BIN = 0x00080000 # not in extmap, read as .bin
+
+AUDIO_STREAMS = [STREAM_VAG, STREAM_MSF]
+
+"""
+Per layout: the registered streams, and the repeating pattern of chunks as (stream, sections per chunk, section size)
+"""
+LAYOUTS = {
+    "vox": ([STREAM_VAG], [(STREAM_VAG, 8, 2048)]),
+    "radio": ([STREAM_DMX, STREAM_VAG, STREAM_BPX], [(STREAM_DMX, 1, 512), (STREAM_VAG, 4, 2048), (STREAM_BPX, 1, 256)]),
+    "demo": ([STREAM_M2V, STREAM_MSF, STREAM_SUB_EN, STREAM_BIN], [(STREAM_M2V, 4, 16384), (STREAM_MSF, 2, 4096), (STREAM_SUB_EN, 1, 128), (STREAM_BIN, 1, 1024)]),
+    "movie": ([STREAM_M2V, STREAM_MSF], [(STREAM_M2V, 16, 65536), (STREAM_MSF, 4, 8192)]),
+}
+
+def build_synthetic_sdt(layout, size, seed, audio_seed=None):
+    """
+    Builds the bytes of a synthetic .sdt of roughly size bytes (at least one round of the layout's pattern).
+    audio_seed changes the audio payloads only, so two files built with the same layout, size and seed
+    but different audio seeds stitch like a Japanese/US pair
+    """
+    streams, pattern = LAYOUTS[layout]
+    rng = random.Random(seed)
+    audio_rng = random.Random(seed if audio_seed is None else audio_seed)
+
+    output = io.BytesIO()
+    writer = SDTWriter(output)
+    for stream_id in streams:
+        writer.register_stream(stream_id)
+    block_indexes = {stream_id: 0 for stream_id in streams}
+
+    while True:
+        for stream_id, n_sections, section_size in pattern:
+            for i in range(n_sections):
+                if stream_id in AUDIO_STREAMS:
+                    data = audio_rng.randbytes(section_size)
+                else:
+                    data = rng.randbytes(section_size)
+                writer.write_section(stream_id, data, block_indexes[stream_id])
+                block_indexes[stream_id] += 1
+
+        if writer.n_written >= size:
+            break
+
+    writer.end()
+    return output.getvalue()
+
+def write_synthetic_sdt(sdt_path, layout, size, seed, audio_seed=None):
+    folder = os.path.dirname(sdt_path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+
+    data = build_synthetic_sdt(layout, size, seed, audio_seed)
+    with open(sdt_path, "wb") as sdt:
+        sdt.write(data)
+    return len(data)
+
+def generate_corpus(root, n_files, sizes, layouts, seed=0):
+    """
+    Writes a pair of trees, root/us and root/jp, with n_files synthetic .sdt files each, in the same layout.
+    Files cycle through the given layouts and sizes. Returns the total number of bytes written
+    """
+    rng = random.Random(seed)
+    n_bytes = 0
+    for i in range(n_files):
+        layout = layouts[i % len(layouts)]
+        size = sizes[i % len(sizes)]
+        file_seed = rng.getrandbits(32)
+
+        relative_path = os.path.join(layout, f"{i // 100:03d}", f"{layout}_{i:05d}.sdt")
+        n_bytes += write_synthetic_sdt(os.path.join(root, "us", relative_path), layout, size, file_seed, audio_seed=file_seed + 1)
+        n_bytes += write_synthetic_sdt(os.path.join(root, "jp", relative_path), layout, size, file_seed, audio_seed=file_seed + 2)
+
+    return n_bytes
+
+def parse_size(text):
+    """
+    Parses sizes like 4096, 64K, 16M or 1G
+    """
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    text = text.strip().upper()
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Writes a synthetic US/Japanese .sdt corpus (root/us and root/jp)")
+    parser.add_argument("root")
+    parser.add_argument("-n", "--files", type=int, default=100, help="number of files per tree (default: 100)")
+    parser.add_argument("--sizes", default="64K,1M", help="comma separated file sizes, cycled through (default: 64K,1M)")
+    parser.add_argument("--layouts", default=",".join(LAYOUTS), help=f"comma separated layouts out of {', '.join(LAYOUTS)}")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    sizes = [parse_size(size) for size in args.sizes.split(",")]
+    layouts = args.layouts.split(",")
+    for layout in layouts:
+        if layout not in LAYOUTS:
+            print(f"Unknown layout {layout}")
+            sys.exit(1)
+
+    n_bytes = generate_corpus(args.root, args.files, sizes, layouts, args.seed)
+    print(f"Wrote {2 * args.files} files ({n_bytes} bytes) to {args.root}")
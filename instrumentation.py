@@ -0,0 +1,219 @@
+"""
+Run Instrumentation
+
+Records where the time of an undub run goes: wall time, bytes read and written and sections parsed,
+per stage (walking folders, peeking at headers, parsing, planning, writing, placing files, ...) and per file.
+The stitching code marks its stages with stage() and counts its I/O with count_read, count_written and count_sections;
+these only cost a few attribute lookups when nothing is being recorded.
+
+Counts go to the innermost stage of the recorder active in the current thread: the FileRecord of the file being
+undubbed (see record_file), or the RunReport of the whole run. Worker processes send their FileRecords back as dicts,
+which the RunReport adds up into a JSON run report with the slowest files.
+"""
+import time
+import threading
+import contextlib
+
+REPORT_VERSION = 1
+
+local = threading.local() # recorder of the current thread
+
+def get_recorder():
+    return getattr(local, "recorder", None)
+
+def new_stage():
+    return {"seconds": 0.0, "calls": 0, "bytes_read": 0, "bytes_written": 0, "n_sections": 0}
+
+class StageRecorder:
+    """
+    Per-stage seconds, calls, bytes read and written and sections parsed
+    """
+    def __init__(self):
+        self.stages = {}
+        self.active_stages = [] # [name, seconds spent in nested stages] of the stages running
+
+    def get_stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = new_stage()
+        return self.stages[name]
+
+    def count(self, key, n):
+        # counts outside of any stage are still kept
+        name = self.active_stages[-1][0] if self.active_stages else "other"
+        self.get_stage(name)[key] += n
+
+    def get_total(self, key):
+        return sum(stage[key] for stage in self.stages.values())
+
+class FileRecord(StageRecorder):
+    """
+    Stages of a single undubbed file
+    """
+    def __init__(self, file):
+        super().__init__()
+        self.file = file
+        self.seconds = 0.0
+        self.action = None
+
+    def to_dict(self):
+        return {
+            "file": str(self.file),
+            "seconds": self.seconds,
+            "action": self.action,
+            "bytes_read": self.get_total("bytes_read"),
+            "bytes_written": self.get_total("bytes_written"),
+            "n_sections": self.get_total("n_sections"),
+            "stages": self.stages,
+        }
+
+class RunReport(StageRecorder):
+    """
+    Stages of a whole run, including the stages of every file added with add_file
+    """
+    def __init__(self):
+        super().__init__()
+        self.start = time.perf_counter()
+        self.files = []
+        self.schedule = None # predicted and actual makespan of the parallel run, see scheduler.WorkSchedule
+
+    def add_file(self, file_record):
+        """
+        Adds a FileRecord.to_dict() (possibly sent back by a worker process)
+        """
+        self.files.append(file_record)
+        for name, file_stage in file_record["stages"].items():
+            stage = self.get_stage(name)
+            for key, value in file_stage.items():
+                stage[key] += value
+
+    def get_slowest_files(self, top=10):
+        return sorted(self.files, key=lambda file_record: -file_record["seconds"])[:top]
+
+    def to_dict(self, top=10):
+        return {
+            "version": REPORT_VERSION,
+            "seconds": time.perf_counter() - self.start,
+            "n_files": len(self.files),
+            "bytes_read": self.get_total("bytes_read"),
+            "bytes_written": self.get_total("bytes_written"),
+            "n_sections": self.get_total("n_sections"),
+            "stages": self.stages,
+            "slowest_files": self.get_slowest_files(top),
+            "schedule": self.schedule,
+            "files": self.files,
+        }
+
+    def print_summary(self, top=10):
+        """
+        Prints the time spent per stage and the slowest files.
+        Stages of files undubbed in parallel add up to more than the wall time
+        """
+        print(f"Run took {time.perf_counter() - self.start:.2f}s for {len(self.files)} files")
+        for name, stage in sorted(self.stages.items(), key=lambda item: -item[1]["seconds"]):
+            print(f"\t{name}: {stage['seconds']:.2f}s over {stage['calls']} calls, "
+                  f"{stage['bytes_read']} bytes read, {stage['bytes_written']} bytes written, {stage['n_sections']} sections")
+
+        if top > 0 and self.files:
+            print(f"Slowest {min(top, len(self.files))} files:")
+            for file_record in self.get_slowest_files(top):
+                print(f"\t{file_record['seconds']:.3f}s {file_record['file']} ({file_record['action']})")
+
+    def save(self, report_path, top=10):
+        from link_copy import save_json
+        save_json(report_path, self.to_dict(top), indent=1)
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Times a stage for the recorder of the current thread; does nothing when nothing is being recorded.
+    Time spent in a nested stage only counts towards the nested stage, so the stages add up to the total
+    """
+    recorder = get_recorder()
+    if recorder is None:
+        yield
+        return
+
+    active_stage = [name, 0.0]
+    recorder.active_stages.append(active_stage)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        recorder.active_stages.pop()
+        if recorder.active_stages:
+            recorder.active_stages[-1][1] += seconds
+        
+        record = recorder.get_stage(name)
+        record["seconds"] += seconds - active_stage[1]
+        record["calls"] += 1
+
+@contextlib.contextmanager
+def record_file(file):
+    """
+    Makes a new FileRecord the recorder of the current thread for the duration of the block, timing it as a whole
+    """
+    file_record = FileRecord(file)
+    previous_recorder = get_recorder()
+    local.recorder = file_record
+    start = time.perf_counter()
+    try:
+        yield file_record
+    finally:
+        file_record.seconds = time.perf_counter() - start
+        local.recorder = previous_recorder
+
+@contextlib.contextmanager
+def record_run(run_report):
+    """
+    Makes a RunReport the recorder of the current thread for the duration of the block
+    """
+    previous_recorder = get_recorder()
+    local.recorder = run_report
+    try:
+        yield run_report
+    finally:
+        local.recorder = previous_recorder
+
+@contextlib.contextmanager
+def resume_recording(recorder):
+    """
+    Makes an existing recorder the recorder of the current thread for the duration of the block,
+    e.g. the FileRecord of a file handed over from another thread
+    """
+    previous_recorder = get_recorder()
+    local.recorder = recorder
+    try:
+        yield recorder
+    finally:
+        local.recorder = previous_recorder
+
+def count_read(n_bytes):
+    recorder = get_recorder()
+    if recorder is not None:
+        recorder.count("bytes_read", n_bytes)
+
+def count_written(n_bytes):
+    recorder = get_recorder()
+    if recorder is not None:
+        recorder.count("bytes_written", n_bytes)
+
+def count_sections(n_sections):
+    recorder = get_recorder()
+    if recorder is not None:
+        recorder.count("n_sections", n_sections)
+
+def profile_call(profile_path, function, *args, **kwargs):
+    """
+    Runs function under cProfile and dumps the stats to profile_path (read them with python -m pstats).
+    Only this process is profiled, not the workers of a pool
+    """
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        profiler.disable()
+        profiler.dump_stats(profile_path)
+        print(f"Profile written to {profile_path} (python -m pstats {profile_path})")
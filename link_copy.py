@@ -0,0 +1,190 @@
+"""
+Linking and Copying
+
+Puts a file in place at a new path as cheaply as the filesystem allows: a reflink (a copy-on-write clone
+sharing the same data blocks), a hardlink, or a kernel-side copy that never passes the data through Python.
+"""
+import io
+import os
+import json
+import shutil
+import contextlib
+
+LINK_MODES = ["auto", "reflink", "hardlink", "copy"]
+
+FICLONE = 0x40049409 # Linux ioctl cloning a whole file (BTRFS, XFS, ...)
+
+def reflink(source_path, destination_path):
+    """
+    Clones a file with copy-on-write. Raises OSError where the platform or filesystem cannot
+    """
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError("reflinks are not supported on this platform")
+
+    with open(source_path, "rb") as source, open(destination_path, "wb") as destination:
+        try:
+            fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+        except OSError:
+            destination.close()
+            os.remove(destination_path)
+            raise
+
+def kernel_copy(source_path, destination_path):
+    """
+    Copies a file with copy_file_range where available, letting the kernel move the data
+    (or share it, on filesystems that support server-side copies). Falls back to shutil.copyfile
+    """
+    if not hasattr(os, "copy_file_range"):
+        shutil.copyfile(source_path, destination_path)
+        return
+
+    with open(source_path, "rb") as source, open(destination_path, "wb") as destination:
+        remaining = os.fstat(source.fileno()).st_size
+        try:
+            while remaining > 0:
+                n_copied = os.copy_file_range(source.fileno(), destination.fileno(), min(remaining, 1 << 30))
+                if n_copied == 0:
+                    break
+                remaining -= n_copied
+        except OSError:
+            # e.g. copies across filesystems on older kernels
+            destination.seek(0)
+            destination.truncate()
+            source.seek(0)
+            shutil.copyfileobj(source, destination, 1024 * 1024)
+
+def get_temp_path(destination_path):
+    # unique per process, so leftovers of an interrupted run are recognisable (see remove_temp_files)
+    return f"{destination_path}.{os.getpid()}.tmp"
+
+def is_temp_path(path):
+    parts = path.rsplit(".", 2)
+    return len(parts) == 3 and parts[1].isdigit() and parts[2] == "tmp"
+
+@contextlib.contextmanager
+def atomic_write(destination_path):
+    """
+    Opens a temporary file next to destination_path for writing, and renames it over destination_path once the block
+    is done, so destination_path is only ever the old file or the complete new one, never a partial file.
+    An existing destination is replaced without writing through it (it may be a hardlink to an input file).
+    The temporary file is removed when the block fails
+    """
+    temp_path = get_temp_path(destination_path)
+    try:
+        with open(temp_path, "wb") as output:
+            yield output
+        os.replace(temp_path, destination_path)
+    except BaseException:
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def save_json(json_path, data, **options):
+    """
+    Writes data as JSON to json_path through atomic_write, so a reader never sees a half written file.
+    options are passed on to json.dumps (e.g. indent)
+    """
+    with atomic_write(json_path) as output:
+        output.write(json.dumps(data, **options).encode("utf-8"))
+
+def remove_temp_files(folder):
+    """
+    Removes the temporary files a killed run left behind in a folder tree. Returns the number of files removed
+    """
+    n_removed = 0
+    for dir_path, dir_names, file_names in os.walk(folder):
+        for file_name in file_names:
+            if is_temp_path(file_name):
+                os.remove(os.path.join(dir_path, file_name))
+                n_removed += 1
+    return n_removed
+
+def advise_willneed(source_path):
+    """
+    Hints the kernel to start reading a whole file into the page cache in the background (posix_fadvise),
+    so a later read finds it there. Does nothing where the platform has no posix_fadvise
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    
+    fd = os.open(source_path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def copy_into(source_path, output_file):
+    """
+    Appends a whole file to an open binary file, with copy_file_range or sendfile where available so the
+    data never passes through Python. Returns the number of bytes written
+    """
+    with open(source_path, "rb") as source:
+        remaining = os.fstat(source.fileno()).st_size
+        size = remaining
+
+        try:
+            output_file.flush()
+            output_fd = output_file.fileno()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            output_fd = None
+
+        copy_function = getattr(os, "copy_file_range", None) or getattr(os, "sendfile", None)
+        if output_fd is not None and copy_function is not None:
+            try:
+                while remaining > 0:
+                    if copy_function is os.sendfile:
+                        n_copied = os.sendfile(output_fd, source.fileno(), size - remaining, min(remaining, 1 << 30))
+                    else:
+                        n_copied = os.copy_file_range(source.fileno(), output_fd, min(remaining, 1 << 30), size - remaining)
+                    if n_copied == 0:
+                        break
+                    remaining -= n_copied
+            except OSError:
+                pass
+            
+            # the kernel moved the file position, not the Python file object's view of it
+            if remaining == 0:
+                output_file.seek(0, os.SEEK_END)
+                return size
+
+            output_file.seek(0, os.SEEK_END)
+
+        source.seek(size - remaining)
+        shutil.copyfileobj(source, output_file, 1024 * 1024)
+        return size
+
+def link_or_copy(source_path, destination_path, mode="auto"):
+    """
+    Puts a copy of source_path at destination_path, replacing whatever is there without writing
+    through it (an existing destination may itself be a hardlink to an input file).
+    mode is "reflink", "hardlink" or "copy", or "auto" to try them in that order.
+    Returns the method that was used
+    """
+    if mode == "auto":
+        methods = ["reflink", "hardlink", "copy"]
+    else:
+        methods = [mode]
+
+    temp_path = get_temp_path(destination_path)
+
+    for method in methods:
+        try:
+            if method == "reflink":
+                reflink(source_path, temp_path)
+            elif method == "hardlink":
+                os.link(source_path, temp_path)
+            else:
+                kernel_copy(source_path, temp_path)
+        except OSError:
+            if os.path.lexists(temp_path):
+                os.remove(temp_path)
+            if method == methods[-1]:
+                raise
+            continue
+
+        os.replace(temp_path, destination_path)
+        return method
@@ -11,119 +11,1061 @@ Written by Matthew Tran (giantlightbulb@gmail.com)
 """
 import os
 import sys
-import pathlib
+import time
+import queue
+import shutil
+import argparse
+import threading
 import traceback
-from smart_file_undub import smart_stitch
+import functools
+import collections
+import multiprocessing
+import concurrent.futures
+from smart_file_undub import smart_stitch, smart_stitch_data, smart_stitch_to_file, smart_stitch_mapped, is_audio_only, check_sdt_path, read_sdt_bytes, STITCH_VERSION
+from manifest import UndubManifest, get_input_signature, is_run_file
+from sdt_index import SDTIndexCache
+from psarc import PsarcMember, split_psarc_path, walk_archive_folder, open_member, pack_folder
+from link_copy import LINK_MODES, link_or_copy, advise_willneed, atomic_write, remove_temp_files
+from instrumentation import RunReport, FileRecord, record_run, record_file, resume_recording, stage, count_written, profile_call
+from undub_plan import UndubPlan, plan_file
+from undub_verify import UndubVerification, verify_file
+from scheduler import WorkSchedule, MemoryBudget, choose_stitch_mode, parse_memory_size
 
-def copy_over_directory(japanese_folder, us_folder, output_folder):
+index_caches = {} # SDTIndexCaches opened by this process, by cache path
+
+PREFETCH_THREADS = 2 # I/O threads reading inputs ahead in the pipelined mode
+
+TASK_BATCH_FILES = 16 # files planned or verified per worker task
+
+def scan_folder(folder):
+    """
+    Walks a folder with os.scandir, reusing the file types the directory listings already hold (nothing is stat'ed),
+    and carrying the subdirectory parts along instead of working them out again from every path.
+    Yields (directory path, subdirectory parts relative to the folder, [(file name, file path)]) per directory,
+    every directory before its subdirectories and everything in name order. Like os.walk, links to folders are not followed
+    """
+    pending = [(folder, ())]
+    while pending:
+        dir_path, sub_directories = pending.pop()
+        files = []
+        directory_names = []
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        directory_names.append(entry.name)
+                else:
+                    files.append((entry.name, entry.path))
+        
+        files.sort()
+        yield dir_path, sub_directories, files
+
+        for name in sorted(directory_names, reverse=True):
+            pending.append((os.path.join(dir_path, name), sub_directories + (name,)))
+
+def walk_input_folder(folder):
+    """
+    Walks an input folder, which can also be a folder inside a .psarc archive (e.g. mgs3_jp.psarc/jp/vox).
+    Yields (directory path, subdirectory parts relative to the folder, [(file name, file path)]) per directory,
+    where files inside archives are given as psarc.PsarcMember instead of a path, to be read without extracting them
+    """
+    archive = split_psarc_path(folder)
+    if archive is None:
+        yield from scan_folder(folder)
+        return
+
+    psarc_path, archive_folder = archive
+    directories = {}
+    for sub_directories, file, member in walk_archive_folder(psarc_path, archive_folder):
+        directories.setdefault(sub_directories, []).append((file, member))
+    
+    for sub_directories in sorted(directories):
+        dir_path = "/".join((psarc_path + archive_folder,) + sub_directories)
+        yield dir_path, sub_directories, directories[sub_directories]
+
+def index_japanese_files(japanese_folder):
+    """
+    Builds a lookup index for every file in the Japanese folder, walking the tree only once.
+    Maps each file name to a list of (relative subdirectory parts, full file path) candidates,
+    as the same file name can appear in several folders.
+    """
+    japanese_index = {}
+
+    for dir_path, sub_directories, files in walk_input_folder(japanese_folder):
+        for file, file_path in files:
+            japanese_index.setdefault(file, []).append((sub_directories, file_path))
+
+    return japanese_index
+
+def find_japanese_file(japanese_index, file, sub_directories):
+    """
+    Finds the Japanese equivalent of a US file in the lookup index, or None if there is none.
+    Ties between candidates with the same file name are broken by relative subpath: an identical
+    subpath wins, otherwise the candidate sharing the most trailing folder names (the vox tree is
+    laid out differently across dubs), with the path itself as a stable final tie-breaker.
+    """
+    candidates = japanese_index.get(file)
+
+    if not candidates:
+        return None
+
+    if len(candidates) == 1:
+        return candidates[0][1]
+
+    sub_directories = tuple(sub_directories)
+
+    def shared_suffix(candidate):
+        candidate_directories = candidate[0]
+        if candidate_directories == sub_directories:
+            return len(sub_directories) + 1
+
+        n_shared = 0
+        for us_part, japanese_part in zip(reversed(sub_directories), reversed(candidate_directories)):
+            if not us_part == japanese_part:
+                break
+            n_shared += 1
+        return n_shared
+
+    # highest score first, alphabetical path for equal scores
+    best = min(candidates, key=lambda candidate: (-shared_suffix(candidate), candidate[1]))
+    return best[1]
+
+def copy_over_directory(japanese_folder, us_folder, output_folder, jobs=1, stitch_mode="memory", index_cache_path=None, incremental=False, link_mode="auto", report=None, plan=None, prefetch=0, max_memory=None):
     """
     Overwrites all US audio with Japaneses audio over a file structure. Completely rebuilds the file structure.
     Utilizes smart_file_undub to properly interleave audio tracks in the files.
     Should be flexible for all .sdt's in MGS3
+    The Japanese and US folders can also be folders inside the .psarc archives (e.g. mgs3_jp.psarc/jp/vox),
+    in which case only the files that are needed are decompressed, as they are read.
+    Files that need no stitching are linked into the output instead of copied, see run_undub_work for the other options (prefetch and max_memory included).
+    Every written file is recorded in a manifest next to the output folder.
+    The time and I/O of every stage and file are recorded in report (an instrumentation.RunReport) when one is given.
+    With a plan (an undub_plan.UndubPlan), nothing is written: the action of every file is planned into it instead.
+    Returns (number of failed files, number of files)
     """
     """
     Force Absolute Paths
     """
-    japanese_folder = pathlib.Path(japanese_folder).absolute().__str__()
-    us_folder = pathlib.Path(us_folder).absolute().__str__()
-    output_folder = pathlib.Path(output_folder).absolute().__str__()
+    japanese_folder = os.path.abspath(japanese_folder)
+    us_folder = os.path.abspath(us_folder)
+    output_folder = os.path.abspath(output_folder)
+
+    if report is None:
+        report = RunReport()
+
+    with record_run(report):
+        with stage("walk"):
+            work, n_files, missing_files = collect_undub_work(japanese_folder, us_folder, output_folder, make_folders=plan is None)
+        n_failed_files = len(missing_files)
 
+        manifest = UndubManifest(output_folder, STITCH_VERSION)
+        if plan is not None:
+            n_failed_files += plan_undub_work(work, missing_files, manifest, plan, jobs, stitch_mode, index_cache_path, incremental, link_mode, max_memory)
+        else:
+            n_failed_files += run_undub_work(work, manifest, jobs, stitch_mode, index_cache_path, incremental, link_mode, report, prefetch, max_memory)
 
+    if n_files:
+        print(f"Proportion of Failed Files: {n_failed_files/n_files}")
+    else:
+        print("No files found")
+
+    return n_failed_files, n_files
+
+def collect_undub_work(japanese_folder, us_folder, output_folder, pass_through_top_level=False, make_folders=True):
+    """
+    Walks the US folder, creating the output folders (unless make_folders is False), and lists the work for every file as (japanese_file, us_file, output_file).
+    .sdt files are paired with their Japanese equivalent to be stitched; every other file is passed through unchanged,
+    which is marked by a japanese_file of None. With pass_through_top_level, the files directly in the US folder are
+    passed through as well (the .sdt files on the top level of demo are the same across both versions).
+    Returns (work, number of files, [(us_file, output_file)] of the .sdt files without a Japanese equivalent, which already failed)
+    """
     """
     Basic Setup
     """
-    us_path = pathlib.Path(us_folder)
-    us_folder_name = us_path.parts[-1]
-
     file_extension = ".sdt"
 	
     """
-    Find all paths for all files in the japanese folder
+    Index all paths for all files in the japanese folder
     """
-    japanese_paths = []
-    japanese_files = []
-    
-    for dir_path, dir_names, files in os.walk(japanese_folder):
-        for file in files:
-            japanese_paths.append(dir_path)
-            japanese_files.append(file)
+    japanese_index = index_japanese_files(japanese_folder)
 
     """
-    Iterate over all files and subfiles
+    Iterate over all files and subfiles, collecting the stitching work
     """
     n_files = 0
-    n_failed_files = 0
-    for dir_path, dir_names, files in os.walk(us_folder):
+    missing_files = []
+    work = []
+    output_paths = []
+    for dir_path, sub_directory_parts, files in walk_input_folder(us_folder):
         """
         Setup the output directory paths
         """
-        true_dir_path = pathlib.Path(dir_path).absolute()
-        index = true_dir_path.parts.index(us_folder_name) # find the index in which the us_folder occurs
-        sub_directories = "\\".join(true_dir_path.parts[index + 1:]) # copy all remaining subdirectory paths
-
-        output_path = f"{output_folder}\\{sub_directories}"
-        if not os.path.exists(output_path):
-            os.mkdir(output_path)
+        output_path = os.path.join(output_folder, *sub_directory_parts) # copy all remaining subdirectory paths
+        output_paths.append(output_path)
         
         print(f"\tCopying for {dir_path}")
         
         # iterate over files in the directory
-        for file in files:
+        for file, us_file in files:
             n_files += 1
-            file_path = pathlib.Path(file)
-            file_name = file_path.name
+
+            # files that need no stitching go into the output unchanged
+            if not os.path.splitext(file)[1] == file_extension or (pass_through_top_level and not sub_directory_parts):
+                work.append((None, us_file, os.path.join(output_path, file)))
+                continue
+
+            japanese_file = find_japanese_file(japanese_index, file, sub_directory_parts)
+            
+            if japanese_file is None:
+                print(f"{os.path.join(dir_path, file)} not found in Japanese files")
+                print(f"Unable to Copy Data Over for {os.path.join(dir_path, file)}")
+                missing_files.append((us_file, os.path.join(output_path, file)))
+                continue
+
+            work.append((japanese_file, us_file, os.path.join(output_path, file)))
+
+    if make_folders:
+        make_output_folders(output_paths)
+
+    return work, n_files, missing_files
+
+def make_output_folders(output_paths):
+    """
+    Creates the output folders in one go once a walk is done, parents before their subfolders (as the walks list them)
+    """
+    for output_path in output_paths:
+        os.makedirs(output_path, exist_ok=True)
+
+def run_undub_work(work, manifest, jobs=1, stitch_mode="memory", index_cache_path=None, incremental=False, link_mode="auto", report=None, prefetch=0, max_memory=None):
+    """
+    Carries out (japanese_file, us_file, output_file) work items, recording every written file in the manifest.
+    With jobs > 1 the files are stitched across a pool of worker processes, largest first and small files in batches
+    (see scheduler.WorkSchedule). Otherwise, with prefetch > 0, the inputs of
+    up to prefetch upcoming files are read ahead while the current one is stitched, see pipeline_undub_work.
+    With max_memory, files are only started while the estimated memory footprint of the files in flight stays under
+    max_memory bytes, and files too big for their share of it are stitched in the constant memory stream mode.
+    stitch_mode is "memory" (whole files in memory), "stream" (constant memory) or "mmap" (zero-copy), see undub_file.
+    index_cache_path points the stream mode at an on-disk SDT index cache, so unchanged files are never re-scanned.
+    With incremental=True, files whose inputs and stitch algorithm are unchanged since the manifest recorded them are skipped.
+    link_mode picks how unchanged files are put into the output, see link_copy.link_or_copy.
+    The record of every file is added to report (an instrumentation.RunReport) when one is given.
+    Returns the number of failed files
+    """
+    # skip files whose inputs and stitch algorithm have not changed since they were last written
+    signatures = {}
+    pending_work = []
+    n_skipped_files = 0
+    with stage("signature"):
+        for japanese_file, us_file, output_file in work:
+            signature = get_input_signature([input_file for input_file in (japanese_file, us_file) if input_file is not None])
+            if incremental and manifest.is_current(output_file, signature):
+                n_skipped_files += 1
+                continue
+
+            signatures[us_file] = (output_file, signature)
+            pending_work.append((japanese_file, us_file, output_file))
+
+    def update_manifest(us_file, error, file_record):
+        output_file, signature = signatures[us_file]
+        if error is None:
+            manifest.record(output_file, signature)
+        else:
+            manifest.forget(output_file)
+        
+        if report is not None:
+            report.add_file(file_record)
+
+    """
+    Stitch every file, either in this process or across a pool of worker processes
+    """
+    n_failed_files = 0
+    try:
+        if jobs > 1:
+            with stage("schedule"):
+                schedule = WorkSchedule(pending_work, jobs, stitch_mode=stitch_mode, max_memory=max_memory)
+            budget = MemoryBudget(max_memory) if max_memory is not None else None
+            
+            batch_task = functools.partial(undub_batch_task, index_cache_path=index_cache_path, link_mode=link_mode)
+            start = time.perf_counter()
+            with multiprocessing.Pool(jobs) as pool:
+                batch_results = dispatch_batches(pool, batch_task, schedule, budget)
+                n_failed_files += report_results(get_batch_results(batch_results, schedule), len(pending_work), update_manifest)
+            schedule.seconds = time.perf_counter() - start
+            if budget is not None:
+                schedule.peak_memory = budget.peak
+            
+            schedule.print_summary()
+            if report is not None:
+                report.schedule = schedule.to_dict()
+        elif prefetch > 0:
+            results = pipeline_undub_work(pending_work, stitch_mode, index_cache_path, link_mode, prefetch, max_memory)
+            n_failed_files += report_results(results, len(pending_work), update_manifest)
+        else:
+            results = (
+                undub_file_task(item, choose_stitch_mode(item, stitch_mode, max_memory)[0], index_cache_path, link_mode)
+                for item in pending_work
+            )
+            n_failed_files += report_results(results, len(pending_work), update_manifest)
+    finally:
+        # keep what was rebuilt so far, even if the run is interrupted
+        with stage("manifest"):
+            manifest.save()
+        commit_index_caches()
+    
+    if incremental:
+        print(f"Skipped {n_skipped_files} unchanged files, rebuilt {len(pending_work)} files")
+
+    return n_failed_files
+
+def plan_undub_work(work, missing_files, manifest, plan, jobs=1, stitch_mode="memory", index_cache_path=None, incremental=False, link_mode="auto", max_memory=None):
+    """
+    Dry run of run_undub_work: plans the action of every (japanese_file, us_file, output_file) work item into plan
+    (an undub_plan.UndubPlan) from header-only scans, along with the (us_file, output_file) missing_files
+    collect_undub_work found no Japanese equivalent for. Stitched files get the stitch mode the run would pick for them,
+    which is the stream mode for files too big for their share of max_memory. Nothing is written, not even the manifest.
+    Returns the number of files predicted to fail, missing files aside
+    """
+    for us_file, output_file in missing_files:
+        plan.add_missing_file(us_file, output_file)
+
+    pending_work = []
+    for japanese_file, us_file, output_file in work:
+        signature = get_input_signature([input_file for input_file in (japanese_file, us_file) if input_file is not None])
+        if incremental and manifest.is_current(output_file, signature):
+            plan.add_skipped_file(japanese_file, us_file, output_file)
+        else:
+            pending_work.append((japanese_file, us_file, output_file))
+
+    task = functools.partial(plan_batch_task, index_cache_path=index_cache_path, link_mode=link_mode)
+    if jobs > 1:
+        with multiprocessing.Pool(jobs) as pool:
+            entries = [entry for batch in pool.imap(task, split_batches(pending_work)) for entry in batch]
+    else:
+        entries = [entry for batch in map(task, split_batches(pending_work)) for entry in batch]
+
+    n_failed_files = 0
+    for item, entry in zip(pending_work, entries):
+        plan.add_file(entry, choose_stitch_mode(item, stitch_mode, max_memory, jobs)[0])
+        if entry["action"] == "fail":
+            n_failed_files += 1
+
+    return n_failed_files
+
+# layout of the extracted archives: the US folders which are stitched with their Japanese equivalent
+# (only the subfolders of demo, its top level files are the same in both versions), and the stage folders
+# whose Japanese .sdx files replace the US ones. Everything else is passed through from the US version.
+STITCH_FOLDERS = [("us/demo", "jp/demo"), ("us/movie", "jp/movie"), ("us/vox", "jp/vox")]
+SDX_FOLDERS = ("us/stage", "jp/stage")
+NOT_UNDUBBED_WARNING = "not found in Japanese files, passed through in English"
+
+def build_output_tree(us_root, japanese_root, output_root, jobs=1, stitch_mode="memory", index_cache_path=None, incremental=False, link_mode="auto", report=None, plan=None, prefetch=0, max_memory=None):
+    """
+    Builds the complete output tree in one run from the roots of both extracted archives (e.g. mgs3_us and mgs3_jpn),
+    which replaces README steps 10 to 15: every US file is passed through (linked where the filesystem allows),
+    the demo, movie and vox folders are stitched, and the Japanese stage .sdx files are copied over.
+    The .sdt files without a Japanese equivalent are passed through as well, with a warning.
+    The manifest is kept next to the output root, and the time and I/O of the run are recorded in report when one is given.
+    With a plan (an undub_plan.UndubPlan), nothing is written: the action of every file is planned into it instead.
+    Returns (number of failed files, number of files)
+    """
+    us_root = os.path.abspath(us_root)
+    japanese_root = os.path.abspath(japanese_root)
+    output_root = os.path.abspath(output_root)
+
+    if report is None:
+        report = RunReport()
+
+    with record_run(report):
+        with stage("walk"):
+            work, n_files, missing_files, unmatched_sdx_files = collect_output_tree_work(us_root, japanese_root, output_root, make_folders=plan is None)
+
+        # the .sdt files without a Japanese equivalent are passed through, they are warned about instead of failing
+        n_failed_files = len(unmatched_sdx_files)
+        manifest = UndubManifest(output_root, STITCH_VERSION)
+
+        if plan is not None:
+            for file_path in unmatched_sdx_files:
+                plan.add_missing_file(file_path, None, "no US equivalent of its folder")
+            n_failed_files += plan_undub_work(work, [], manifest, plan, jobs, stitch_mode, index_cache_path, incremental, link_mode, max_memory)
+            for us_file, output_file in missing_files:
+                plan.add_warning(output_file, NOT_UNDUBBED_WARNING)
+        else:
+            n_failed_files += run_undub_work(work, manifest, jobs, stitch_mode, index_cache_path, incremental, link_mode, report, prefetch, max_memory)
+            for us_file, output_file in missing_files:
+                print(f"Warning: {us_file}: {NOT_UNDUBBED_WARNING}")
+
+        if n_files:
+            print(f"Proportion of Failed Files: {n_failed_files/n_files}")
+        else:
+            print("No files found")
+
+        return n_failed_files, n_files
+
+def collect_output_tree_work(us_root, japanese_root, output_root, make_folders=True):
+    """
+    collect_undub_work over the whole tree of build_output_tree: the stitched folders, then everything else
+    of the US root, passed through, except for the stage .sdx files, which are passed through from the Japanese
+    stage instead (see collect_sdx_work), so the manifest records the Japanese files that end up in the output.
+    The .sdt files without a Japanese equivalent are passed through as well, so the tree has no holes.
+    Returns (work, number of files, [(us_file, output_file)] of the .sdt files without a Japanese equivalent
+    (passed through), [file_path] of the Japanese .sdx files without an equivalent US folder)
+    """
+    work = []
+    n_files = 0
+    missing_files = []
+
+    # stitched folders
+    stitched_folders = set()
+    for us_folder, japanese_folder in STITCH_FOLDERS:
+        us_path = os.path.join(us_root, *us_folder.split("/"))
+        japanese_path = os.path.join(japanese_root, *japanese_folder.split("/"))
+        print(f"Undubbing {us_path}")
+
+        folder_work, folder_n_files, folder_missing_files = collect_undub_work(
+            japanese_path, us_path, os.path.join(output_root, *us_folder.split("/")),
+            pass_through_top_level=(us_folder == "us/demo"), make_folders=make_folders
+        )
+        work += folder_work
+        n_files += folder_n_files
+        missing_files += folder_missing_files
+        stitched_folders.add(tuple(us_folder.split("/")))
+
+    # a complete tree needs every file, the ones that cannot be undubbed are left in English
+    work += [(None, us_file, output_file) for us_file, output_file in missing_files]
+
+    # everything else is passed through
+    print(f"Passing through the rest of {us_root}")
+    output_paths = []
+    for dir_path, sub_directory_parts, files in walk_input_folder(us_root):
+        if any(sub_directory_parts[:len(folder)] == folder for folder in stitched_folders):
+            continue
+        
+        output_path = os.path.join(output_root, *sub_directory_parts)
+        output_paths.append(output_path)
+        
+        for file, us_file in files:
+            n_files += 1
+            work.append((None, us_file, os.path.join(output_path, file)))
+    
+    if make_folders:
+        make_output_folders(output_paths)
+
+    # the Japanese .sdx files replace the US ones
+    sdx_work, unmatched_sdx_files = collect_sdx_work(*get_sdx_folders(us_root, japanese_root, output_root), make_folders=make_folders)
+    if unmatched_sdx_files:
+        print(f"{len(unmatched_sdx_files)} Japanese .sdx files without a US equivalent")
+    sdx_outputs = set(output_file for file_path, output_file in sdx_work)
+    n_files -= sum(1 for item in work if item[2] in sdx_outputs)
+    work = [item for item in work if item[2] not in sdx_outputs] + [(None, file_path, output_file) for file_path, output_file in sdx_work]
+    n_files += len(sdx_work) + len(unmatched_sdx_files)
+
+    return work, n_files, missing_files, unmatched_sdx_files
+
+def get_sdx_folders(us_root, japanese_root, output_root):
+    """
+    (japanese_stage, us_stage, output_stage) folders of collect_sdx_work in the tree of build_output_tree
+    """
+    us_stage, japanese_stage = SDX_FOLDERS
+    return (
+        os.path.join(japanese_root, *japanese_stage.split("/")),
+        os.path.join(us_root, *us_stage.split("/")),
+        os.path.join(output_root, *us_stage.split("/")),
+    )
+
+def get_index_cache(index_cache_path):
+    """
+    Opens an SDT index cache once per process, as connections cannot be shared with worker processes
+    """
+    if index_cache_path is None:
+        return None
+
+    if index_cache_path not in index_caches:
+        index_caches[index_cache_path] = SDTIndexCache(index_cache_path)
+    
+    return index_caches[index_cache_path]
+
+def commit_index_caches():
+    """
+    Writes the new indexes of every SDT index cache opened by this process. Pool workers are stopped without
+    a chance to commit on exit, so every task that runs in a worker commits once it is done with its batch of files
+    """
+    for index_cache in index_caches.values():
+        index_cache.commit()
+
+def split_batches(work, batch_files=TASK_BATCH_FILES):
+    return [work[i:i + batch_files] for i in range(0, len(work), batch_files)]
+
+def undub_file(japanese_file, us_file, output_file, stitch_mode="memory", index_cache=None, link_mode="auto", audio_only=None):
+    """
+    Copies the Japanese audio over the English audio of a single .sdt and writes it to a new file.
+    Without a japanese_file the US file is passed through unchanged, and audio only Japanese files, which stitching
+    would reproduce byte for byte, are passed through in place of the stitch; both are linked where the filesystem allows.
+    The "stream" stitch mode only scans headers up front and copies sections straight into the output file,
+    so memory stays flat even for the multi-hundred-MB movie files.
+    The "mmap" stitch mode memory maps both files and writes the stitched sections straight from the mapped pages.
+    index_cache (an SDTIndexCache) saves the stream mode from re-scanning files it has already indexed.
+    audio_only is whether the Japanese file is audio only, when it has already been peeked at.
+    Returns what was done, e.g. "stitch (stream)" or "audio only (hardlink)"
+    """
+    if japanese_file is None:
+        return f"pass through ({place_file(us_file, output_file, link_mode)})"
+    
+    if audio_only is None:
+        audio_only = is_audio_only(japanese_file, index_cache)
+    if audio_only:
+        # the US file is only validated, the Japanese one is the output
+        check_sdt_path(us_file)
+        return f"audio only ({place_file(japanese_file, output_file, link_mode)})"
+    
+    # outputs only appear once complete, and never write through an existing output (it may be a link to an input file)
+    if stitch_mode == "stream":
+        with atomic_write(output_file) as output:
+            smart_stitch_to_file(japanese_file, us_file, output, index_cache=index_cache)
+        return "stitch (stream)"
+    
+    if stitch_mode == "mmap":
+        with atomic_write(output_file) as output:
+            smart_stitch_mapped(japanese_file, us_file, output)
+        return "stitch (mmap)"
+
+    output_data = smart_stitch(japanese_file, us_file)
+
+    """
+    # dumb over copy, blindly acts based on a magic line
+    japanese_file = open(f"{japanese_folder}\\{sub_directories}\\{file}", "rb")
+    english_file = open(f"{dir_path}\\{file}", "rb")
+    japanese_data = japanese_file.read()
+    english_data = english_file.read()
+
+    output_data = copy_audio_bytes(japanese_data, english_data)
+
+    japanese_file.close()
+    english_file.close()
+    """
+
+    write_output_data(output_file, output_data)
+    return "stitch (memory)"
+
+def write_output_data(output_file, output_data):
+    """
+    Writes a file stitched in memory, replacing whatever is at output_file without writing through it
+    """
+    with stage("write"), atomic_write(output_file) as output:
+        output.write(output_data)
+        count_written(len(output_data))
+
+def undub_file_task(item, stitch_mode="memory", index_cache_path=None, link_mode="auto"):
+    """
+    Runs undub_file for one (japanese_file, us_file, output_file) work item.
+    Never raises, so it is safe to run in a worker process.
+    Returns (us_file, error traceback or None, the instrumentation.FileRecord of the file as a dict)
+    """
+    japanese_file, us_file, output_file = item
+    with record_file(us_file) as file_record:
+        try:
+            file_record.action = undub_file(japanese_file, us_file, output_file, stitch_mode, get_index_cache(index_cache_path), link_mode)
+        except (Exception, SystemExit):
+            # read_in_sections calls exit() on malformed files, which would otherwise kill a pool worker
+            file_record.action = "failed"
+            error = traceback.format_exc()
+        else:
+            error = None
+    
+    return us_file, error, file_record.to_dict()
+
+def undub_batch_task(batch, index_cache_path=None, link_mode="auto"):
+    """
+    Runs undub_file_task for every (work item, stitch mode) of a batch, in a worker process.
+    Returns (the pid of the worker, seconds the batch took, [undub_file_task result])
+    """
+    start = time.perf_counter()
+    results = [undub_file_task(item, stitch_mode, index_cache_path, link_mode) for item, stitch_mode in batch]
+    commit_index_caches()
+    return os.getpid(), time.perf_counter() - start, results
+
+def dispatch_batches(pool, batch_task, schedule, budget=None):
+    """
+    Hands the batches of a scheduler.WorkSchedule to a pool, largest first, and yields their results as they come in.
+    With a budget (a scheduler.MemoryBudget), a batch is only handed out once its footprint fits next to the batches
+    in flight, and no more batches are in flight than there are workers; smaller batches further down the schedule
+    that fit go ahead of a big one that does not
+    """
+    if budget is None:
+        yield from pool.imap_unordered(batch_task, schedule.batches, chunksize=1)
+        return
+
+    done = queue.Queue()
+    waiting = list(range(len(schedule.batches)))
+    n_in_flight = 0
+    while waiting or n_in_flight:
+        for i in list(waiting):
+            if n_in_flight >= schedule.jobs:
+                break
+            if budget.try_acquire(schedule.batch_footprints[i]):
+                waiting.remove(i)
+                pool.apply_async(
+                    batch_task, (schedule.batches[i],),
+                    callback=functools.partial(put_batch_result, done, i), error_callback=functools.partial(put_batch_result, done, i)
+                )
+                n_in_flight += 1
+        
+        i, result = done.get()
+        budget.release(schedule.batch_footprints[i])
+        n_in_flight -= 1
+        if isinstance(result, BaseException):
+            raise result
+        yield result
+
+def put_batch_result(done, i, result):
+    done.put((i, result))
+
+def get_batch_results(batch_results, schedule):
+    """
+    Unpacks undub_batch_task results into the results of every file, recording the busy time of every worker in schedule
+    """
+    for worker, seconds, results in batch_results:
+        schedule.add_batch_result(worker, seconds)
+        yield from results
+
+def prefetch_undub_item(item, file_record, stitch_mode="memory"):
+    """
+    Reader side of pipeline_undub_work, run on an I/O thread: hints the kernel to read the inputs of a work item,
+    peeks at whether the Japanese file is audio only and, for files stitched in memory, reads both of them whole.
+    What is read is recorded in file_record, the instrumentation.FileRecord of the item, which is only handed back
+    to the stitching thread once this returns.
+    Returns (when reading started, whether the Japanese file is audio only or None without one,
+    (japanese_data, us_data), or None for files that are not stitched in memory)
+    """
+    start = time.perf_counter()
+    japanese_file, us_file, output_file = item
+    with resume_recording(file_record):
+        for input_file in (japanese_file, us_file):
+            if input_file is not None and not isinstance(input_file, PsarcMember):
+                advise_willneed(input_file)
+        
+        if japanese_file is None:
+            return start, None, None
+        
+        audio_only = is_audio_only(japanese_file)
+        if audio_only or not stitch_mode == "memory":
+            return start, audio_only, None
+        
+        check_sdt_path(japanese_file)
+        japanese_data = read_sdt_bytes(japanese_file)
+        check_sdt_path(us_file)
+        us_data = read_sdt_bytes(us_file)
+        return start, audio_only, (japanese_data, us_data)
+
+def write_undub_outputs(write_queue, results, budget=None):
+    """
+    Writer side of pipeline_undub_work, run on its own thread: writes the files stitched in memory as they come in
+    on write_queue as (us_file, output_file, output_data, file record, start, footprint), until it gets None.
+    Puts (us_file, error traceback or None, file record as a dict) on results for every file, and gives the
+    footprint of every written file back to budget (a scheduler.MemoryBudget) when there is one
+    """
+    while True:
+        job = write_queue.get()
+        if job is None:
+            return
+        
+        us_file, output_file, output_data, file_record, start, footprint = job
+        with resume_recording(file_record):
+            try:
+                write_output_data(output_file, output_data)
+                file_record.action = "stitch (memory)"
+                error = None
+            except Exception:
+                file_record.action = "failed"
+                error = traceback.format_exc()
+        
+        output_data = None
+        if budget is not None:
+            budget.release(footprint)
+        
+        file_record.seconds = time.perf_counter() - start
+        results.put((us_file, error, file_record.to_dict()))
+
+def pipeline_undub_work(work, stitch_mode="memory", index_cache_path=None, link_mode="auto", prefetch=4, max_memory=None, io_threads=PREFETCH_THREADS):
+    """
+    Pipelined version of running undub_file_task over (japanese_file, us_file, output_file) work items in this process.
+    io_threads threads read the inputs of up to prefetch upcoming files ahead (see prefetch_undub_item) while the current
+    file is stitched, and a writer thread writes the stitched files, so reading, stitching and writing overlap instead of alternating.
+    Only files stitched in memory are read ahead whole, the other files have their inputs hinted to the kernel.
+    With max_memory, files are only read ahead while the estimated footprint of the files in flight (read ahead,
+    being stitched or waiting to be written) stays under max_memory bytes, and bigger files are stitched in the stream mode.
+    Yields (us_file, error traceback or None, file record as a dict) for every file, as they are done
+    """
+    index_cache = get_index_cache(index_cache_path)
+    budget = MemoryBudget(max_memory) if max_memory is not None else None
+    results = queue.Queue()
+    write_queue = queue.Queue(maxsize=max(1, prefetch))
+    writer = threading.Thread(target=write_undub_outputs, args=(write_queue, results, budget), daemon=True)
+    writer.start()
+
+    def get_results():
+        while True:
             try:
-                # make sure we're working with .sdt files
-                if file_path.suffix == file_extension:
-                    # copy the Japanese audio over the English audio and write to a new file in the output folder
-                    index = japanese_files.index(file)
-                    
-                    if index == -1:
-                        raise Exception(f"{dir_path}\\{file_path} not found in Japanese files")
-                    
-                    japanese_file = f"{japanese_paths[index]}\\{japanese_files[index]}"
-					
-                    us_file = f"{dir_path}\\{file}"
-                    output_data = smart_stitch(japanese_file, us_file)
-
-                    """
-                    # dumb over copy, blindly acts based on a magic line
-                    japanese_file = open(f"{japanese_folder}\\{sub_directories}\\{file}", "rb")
-                    english_file = open(f"{dir_path}\\{file}", "rb")
-                    japanese_data = japanese_file.read()
-                    english_data = english_file.read()
-
-                    output_data = copy_audio_bytes(japanese_data, english_data)
-
-                    japanese_file.close()
-                    english_file.close()
-                    """
-
-                    with open(f"{output_path}\\{file_name}", "wb") as output_file:
-                        output_file.write(output_data)
-
-                    
-            except Exception as e:
+                yield results.get_nowait()
+            except queue.Empty:
+                return
+
+    upcoming = collections.deque(work)
+    prefetched = collections.deque()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max(1, io_threads)) as readers:
+            def prefetch_next(wait=False):
+                """
+                Starts reading the next work item ahead, if there is one and its footprint fits in the budget
+                (or once it fits, with wait). Returns whether an item was started
+                """
+                if not upcoming or len(prefetched) >= max(1, prefetch):
+                    return False
+                
+                item = upcoming[0]
+                item_stitch_mode, footprint = choose_stitch_mode(item, stitch_mode, max_memory)
+                if budget is not None:
+                    if wait:
+                        budget.acquire(footprint)
+                    elif not budget.try_acquire(footprint):
+                        return False
+                
+                upcoming.popleft()
+                file_record = FileRecord(item[1])
+                future = readers.submit(prefetch_undub_item, item, file_record, item_stitch_mode)
+                prefetched.append((item, item_stitch_mode, footprint, file_record, future))
+                return True
+
+            while prefetched or upcoming:
+                if not prefetched:
+                    # nothing fits next to the files still being written, wait for the writer to free some memory
+                    prefetch_next(wait=True)
+                while prefetch_next():
+                    pass
+
+                item, item_stitch_mode, footprint, file_record, future = prefetched.popleft()
+                japanese_file, us_file, output_file = item
+                start = time.perf_counter()
+                output_data = None
+                with resume_recording(file_record):
+                    try:
+                        start, audio_only, inputs = future.result()
+                        if inputs is None:
+                            file_record.action = undub_file(japanese_file, us_file, output_file, item_stitch_mode, index_cache, link_mode, audio_only)
+                        else:
+                            output_data = smart_stitch_data(*inputs)
+                        inputs = None
+                    except (Exception, SystemExit):
+                        # the SDT parsers call exit() on malformed files
+                        file_record.action = "failed"
+                        error = traceback.format_exc()
+                    else:
+                        error = None
+                
+                if output_data is not None:
+                    # the writer thread reports the file once it is written, and frees its memory
+                    write_queue.put((us_file, output_file, output_data, file_record, start, footprint))
+                    output_data = None
+                else:
+                    if budget is not None:
+                        budget.release(footprint)
+                    file_record.seconds = time.perf_counter() - start
+                    results.put((us_file, error, file_record.to_dict()))
+                
+                yield from get_results()
+    finally:
+        write_queue.put(None)
+        writer.join()
+    
+    yield from get_results()
+
+def plan_batch_task(batch, index_cache_path=None, link_mode="auto"):
+    """
+    Runs undub_plan.plan_file for a batch of (japanese_file, us_file, output_file) work items, in this process
+    or a worker process. Returns the plan entries, in order
+    """
+    index_cache = get_index_cache(index_cache_path)
+    entries = [plan_file(japanese_file, us_file, output_file, link_mode, index_cache) for japanese_file, us_file, output_file in batch]
+    commit_index_caches()
+    return entries
+
+def verify_batch_task(batch, index_cache_path=None):
+    """
+    Runs undub_verify.verify_file for a batch of (japanese_file, us_file, output_file) work items, in this process
+    or a worker process. Returns the results, in order
+    """
+    index_cache = get_index_cache(index_cache_path)
+    results = [verify_file(japanese_file, us_file, output_file, index_cache) for japanese_file, us_file, output_file in batch]
+    commit_index_caches()
+    return results
+
+def verify_output(us_folder, japanese_folder, output_folder, jobs=1, index_cache_path=None, full_tree=False):
+    """
+    Verifies the output folder of copy_over_directory (or, with full_tree, the output root of build_output_tree)
+    against its inputs, across jobs worker processes, see undub_verify. Returns an undub_verify.UndubVerification
+    """
+    us_folder = os.path.abspath(us_folder)
+    japanese_folder = os.path.abspath(japanese_folder)
+    output_folder = os.path.abspath(output_folder)
+    verification = UndubVerification()
+
+    if full_tree:
+        work, n_files, missing_files, unmatched_sdx_files = collect_output_tree_work(us_folder, japanese_folder, output_folder, make_folders=False)
+    else:
+        work, n_files, missing_files = collect_undub_work(japanese_folder, us_folder, output_folder, make_folders=False)
+
+    if full_tree:
+        # passed through by build_output_tree, verified as such
+        for us_file, output_file in missing_files:
+            print(f"Warning: {us_file}: {NOT_UNDUBBED_WARNING}")
+    else:
+        for us_file, output_file in missing_files:
+            verification.add_file({"file": output_file, "us_file": str(us_file), "japanese_file": None, "problems": ["no Japanese equivalent, it was never undubbed"]})
+
+    print(f"Verifying {len(work)} files")
+    task = functools.partial(verify_batch_task, index_cache_path=index_cache_path)
+    if jobs > 1:
+        with multiprocessing.Pool(jobs) as pool:
+            for results in pool.imap_unordered(task, split_batches(work)):
+                for result in results:
+                    verification.add_file(result)
+    else:
+        for batch in split_batches(work):
+            for result in task(batch):
+                verification.add_file(result)
+
+    return verification
+
+def report_results(results, n_total, on_result=None):
+    """
+    Prints progress and failures as stitch results come in (in any order), returns the number of failed files.
+    on_result is called with (us_file, error traceback or None, file record) for every result
+    """
+    n_done = 0
+    n_failed = 0
+    progress_step = max(1, n_total // 100)
+
+    for us_file, error, file_record in results:
+        n_done += 1
+        if error is not None:
+            print(error)
+            print(f"Unable to Copy Data Over for {us_file}")
+            n_failed += 1
+        
+        if on_result is not None:
+            on_result(us_file, error, file_record)
+        
+        if n_done % progress_step == 0 or n_done == n_total:
+            print(f"\tProcessed {n_done}/{n_total} files ({n_failed} failed)")
+    
+    return n_failed
+
+def place_file(source_file, output_file, link_mode="auto"):
+    """
+    Puts an input file unchanged into the output tree, linking it where the filesystem allows (see link_copy).
+    Files inside archives are decompressed into place. Returns the method that was used
+    """
+    with stage("place"):
+        if isinstance(source_file, PsarcMember):
+            with open_member(source_file) as member, atomic_write(output_file) as output:
+                shutil.copyfileobj(member, output, 1024 * 1024)
+                count_written(output.tell())
+            return "extract"
+
+        method = link_or_copy(source_file, output_file, link_mode)
+        if method == "copy":
+            # links share the data of their input, only copies write it
+            count_written(os.path.getsize(output_file))
+        return method
+
+def place_file_task(source_file, output_file, link_mode="auto"):
+    """
+    Runs place_file on a worker thread, returning (the method that was used, the instrumentation.FileRecord of the file as a dict)
+    """
+    with record_file(source_file) as file_record:
+        file_record.action = place_file(source_file, output_file, link_mode)
+    return file_record.action, file_record.to_dict()
+
+def collect_sdx_work(japanese_stage, us_stage, output_stage, make_folders=True):
+    """
+    Walks the Japanese stage folder, creating the output folders (unless make_folders is False), and lists every .sdx
+    that has an equivalent folder in the US stage as (file_path, output_file).
+    Returns (work, [file_path] of the .sdx files without an equivalent folder)
+    """
+    japanese_stage = os.path.abspath(japanese_stage)
+    us_stage = os.path.abspath(us_stage)
+    output_stage = os.path.abspath(output_stage)
+
+    # every folder of the US stage, which may be inside an archive
+    us_directories = set()
+    for dir_path, sub_directory_parts, files in walk_input_folder(us_stage):
+        for i in range(len(sub_directory_parts) + 1):
+            us_directories.add(sub_directory_parts[:i])
+
+    unmatched_files = []
+    work = []
+    output_paths = []
+    for dir_path, sub_directory_parts, files in walk_input_folder(japanese_stage):
+        sdx_files = [(file, file_path) for file, file_path in files if os.path.splitext(file)[1] == ".sdx"]
+        if not sdx_files:
+            continue
+
+        if sub_directory_parts not in us_directories:
+            print(f"No US equivalent of {dir_path}, skipping {len(sdx_files)} .sdx files")
+            unmatched_files += [file_path for file, file_path in sdx_files]
+            continue
+        
+        output_path = os.path.join(output_stage, *sub_directory_parts)
+        output_paths.append(output_path)
+        
+        for file, file_path in sdx_files:
+            work.append((file_path, os.path.join(output_path, file)))
+    
+    if make_folders:
+        make_output_folders(output_paths)
+
+    return work, unmatched_files
+
+def copy_sdx_files(japanese_stage, us_stage, output_stage, jobs=1, link_mode="auto", report=None):
+    """
+    Copies every Japanese .sdx in the stage folder to the equivalent folder of the output stage folder,
+    replacing the US .sdx files. A Japanese file only has an equivalent when the US stage has a folder of the
+    same name. Files are copied concurrently, and linked instead of copied where the filesystem allows.
+    The record of every file is added to report (an instrumentation.RunReport) when one is given.
+    Returns (number of failed files, number of files)
+    """
+    work, unmatched_files = collect_sdx_work(japanese_stage, us_stage, output_stage)
+    n_unmatched_files = len(unmatched_files)
+    n_failed_files = 0
+
+    methods = {}
+    with concurrent.futures.ThreadPoolExecutor(max(1, jobs)) as executor:
+        futures = {executor.submit(place_file_task, file_path, output_file, link_mode): file_path for file_path, output_file in work}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                method, file_record = future.result()
+            except Exception:
                 print(traceback.format_exc())
-                print(f"Unable to Copy Data Over for {dir_path}\\{file}")
+                print(f"Unable to Copy {futures[future]}")
                 n_failed_files += 1
+                continue
+            methods[method] = methods.get(method, 0) + 1
+            if report is not None:
+                report.add_file(file_record)
     
-    print(f"Proportion of Failed Files: {n_failed_files/n_files}")
+    summary = ", ".join(f"{n} by {method}" for method, n in sorted(methods.items()))
+    print(f"Placed {sum(methods.values())} .sdx files ({summary}), {n_failed_files} failed, {n_unmatched_files} without a US equivalent")
 
-if __name__ == "__main__":
-    print("Usage:")
-    print("python main.py us_folder japanese_folder output_folder_path")
-    if len(sys.argv) == 4:
-        us_folder = sys.argv[1]
-        japanese_folder = sys.argv[2]
-        output_folder = sys.argv[3]
-    else:
-        us_folder = "./us/"
-        japanese_folder = "./japanese/"
-        output_folder = "./output/"
-    print()
+    return n_failed_files + n_unmatched_files, len(work) + n_unmatched_files
+
+def undub_main(argv):
+    parser = argparse.ArgumentParser(description="Copies Japanese audio over US audio for every .sdt in a folder structure")
+    parser.add_argument("us_folder", nargs="?", default="./us/")
+    parser.add_argument("japanese_folder", nargs="?", default="./japanese/")
+    parser.add_argument("output_folder", nargs="?", default="./output/")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="number of worker processes used to stitch files (default: 1)")
+    parser.add_argument("--stitch-mode", choices=["memory", "stream", "mmap"], default="memory", help="memory: hold whole files in memory (default), stream: constant memory, copies sections straight to the output, mmap: zero-copy writes from memory mapped inputs")
+    parser.add_argument("--index-cache", default=None, help="SQLite file caching SDT header indexes between runs, used by the stream stitch mode")
+    parser.add_argument("--incremental", action="store_true", help="skip files whose inputs and stitch algorithm are unchanged since the last run")
+    parser.add_argument("--resume", action="store_true", help="continue an interrupted run: skip every file it completed (from the manifest and the journal of completed files) and remove its temporary files")
+    parser.add_argument("--link", choices=LINK_MODES, default="auto", help="how files that need no stitching are put into the output. auto: reflink, else hardlink, else copy (default)")
+    parser.add_argument("--full-tree", action="store_true", help="the folders are the roots of both extracted archives (e.g. mgs3_us mgs3_jpn): build the complete output tree in one run")
+    parser.add_argument("--report", default=None, metavar="JSON", help="write a JSON report of the time, bytes read and written and sections per stage and per file, and print a summary")
+    parser.add_argument("--top", type=int, default=10, help="number of slowest files listed in the report summary (default: 10)")
+    parser.add_argument("--profile", default=None, metavar="PSTATS", help="run under cProfile and write the stats to this file (only the main process, use with -j 1)")
+    parser.add_argument("--prefetch", type=int, default=0, metavar="N", help="with -j 1, read the inputs of up to N upcoming files on I/O threads while the current one is stitched, and write on a writer thread (default: 0, off)")
+    parser.add_argument("--max-memory", type=parse_memory_size, default=None, metavar="SIZE", help="memory budget of the files being stitched at once (e.g. 4G): files only start while their estimated footprint fits, and files too big for their share of it are stitched in the stream mode")
+    parser.add_argument("--plan", default=None, metavar="JSON", help="dry run: write what would be done to every file (actions, chunk counts, expected sizes, predicted failures) to this file, from section headers only, without writing any output")
+    args = parser.parse_args(argv)
 
     print("Copying Japanse Audio Over US Audio")
-    print(f"{japanese_folder} and {us_folder} to {output_folder}")
+    print(f"{args.japanese_folder} and {args.us_folder} to {args.output_folder}")
+    
+    if args.resume and not args.plan and os.path.isdir(args.output_folder):
+        n_removed = remove_temp_files(args.output_folder)
+        print(f"Resuming, removed {n_removed} temporary files left by the interrupted run")
+    
+    report = RunReport()
+    plan = UndubPlan(args.stitch_mode) if args.plan else None
+    incremental = args.incremental or args.resume
+    options = dict(jobs=args.jobs, stitch_mode=args.stitch_mode, index_cache_path=args.index_cache, incremental=incremental, link_mode=args.link, report=report, plan=plan, prefetch=args.prefetch, max_memory=args.max_memory)
+    if args.full_tree:
+        run = functools.partial(build_output_tree, args.us_folder, args.japanese_folder, args.output_folder, **options)
+    else:
+        run = functools.partial(copy_over_directory, args.japanese_folder, args.us_folder, args.output_folder, **options)
+    
+    if args.profile:
+        profile_call(args.profile, run)
+    else:
+        run()
+    
+    if plan is not None:
+        plan.print_summary()
+        plan.save(args.plan)
+        print(f"Plan written to {args.plan}")
+
+    if args.report:
+        report.print_summary(args.top)
+        report.save(args.report, args.top)
+        print(f"Report written to {args.report}")
+
+def pack_main(argv):
+    parser = argparse.ArgumentParser(prog="main.py pack", description="Packs the undub output into a PSARC 1.4 archive (zlib, absolute path names) to replace mgs3.psarc")
+    parser.add_argument("output_folder", help="folder to pack, its contents become the root of the archive")
+    parser.add_argument("psarc_path", help="archive to write, e.g. mgs3.psarc")
+    parser.add_argument("-j", "--jobs", type=int, default=multiprocessing.cpu_count(), help="number of worker processes compressing blocks (default: all cores)")
+    parser.add_argument("--ratio", type=int, choices=range(0, 10), default=9, metavar="0-9", help="zlib compression ratio (default: 9)")
+    parser.add_argument("--reuse", default=None, metavar="PSARC", help="original mgs3.psarc: blocks of unchanged files are copied from it still compressed instead of being compressed again")
+    args = parser.parse_args(argv)
+
+    print(f"Packing {args.output_folder} into {args.psarc_path}")
+
+    # manifests, journals and leftover temporary files of undub runs into subfolders are not game files
+    pack_folder(args.output_folder, args.psarc_path, jobs=args.jobs, ratio=args.ratio, reuse_psarc_path=args.reuse, skip_file=is_run_file)
+
+def sdx_main(argv):
+    parser = argparse.ArgumentParser(prog="main.py sdx", description="Copies the Japanese .sdx files of the stage folder into the equivalent output stage folders")
+    parser.add_argument("japanese_stage", help="e.g. mgs3_jpn/jp/stage")
+    parser.add_argument("us_stage", help="e.g. mgs3_us/us/stage, to find the equivalent folders")
+    parser.add_argument("output_stage", help="e.g. output_folder/us/stage")
+    parser.add_argument("-j", "--jobs", type=int, default=8, help="number of files copied at once (default: 8)")
+    parser.add_argument("--link", choices=LINK_MODES, default="auto", help="auto: reflink, else hardlink, else copy (default), or force one of them")
+    args = parser.parse_args(argv)
+
+    print(f"Copying Japanese .sdx files from {args.japanese_stage} to {args.output_stage}")
+
+    copy_sdx_files(args.japanese_stage, args.us_stage, args.output_stage, jobs=args.jobs, link_mode=args.link)
+
+def verify_main(argv):
+    parser = argparse.ArgumentParser(prog="main.py verify", description="Checks that every .sdt of an undub output is well formed and matches its inputs, from section headers only")
+    parser.add_argument("us_folder")
+    parser.add_argument("japanese_folder")
+    parser.add_argument("output_folder")
+    parser.add_argument("-j", "--jobs", type=int, default=multiprocessing.cpu_count(), help="number of worker processes scanning files (default: all cores)")
+    parser.add_argument("--full-tree", action="store_true", help="the folders are the roots of both extracted archives and the output root of a --full-tree run")
+    parser.add_argument("--index-cache", default=None, help="SQLite file caching SDT header indexes between runs, so the inputs are not scanned again")
+    parser.add_argument("--report", default=None, metavar="JSON", help="write the result of every file to this file")
+    args = parser.parse_args(argv)
+
+    print(f"Verifying {args.output_folder} against {args.us_folder} and {args.japanese_folder}")
+
+    verification = verify_output(args.us_folder, args.japanese_folder, args.output_folder, args.jobs, args.index_cache, args.full_tree)
+    verification.print_summary()
+
+    if args.report:
+        verification.save(args.report)
+        print(f"Report written to {args.report}")
     
-    copy_over_directory(japanese_folder, us_folder, output_folder)
\ No newline at end of file
+    if verification.get_failures():
+        sys.exit(1)
+
+COMMANDS = {
+    "pack": pack_main,
+    "sdx": sdx_main,
+    "verify": verify_main,
+}
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        COMMANDS[sys.argv[1]](sys.argv[2:])
+    else:
+        undub_main(sys.argv[1:])
@@ -0,0 +1,154 @@
+"""
+Undub Manifest
+
+Records, for every file written to an output folder, the (size, mtime) of the input files it was
+built from and the stitch algorithm version used, so unchanged files can be skipped on the next run.
+The manifest is a JSON file stored next to the output folder (output_folder.manifest.json).
+
+As the manifest is only saved at the end of a run, every file is also appended to a journal the moment it is
+recorded (output_folder.journal.jsonl, one JSON line per file). A run that dies before saving the manifest leaves
+its journal behind, which the next run replays on top of the manifest, so no completed file is lost.
+Saving the manifest makes the journal redundant, and it is removed.
+"""
+import os
+import json
+from psarc import PsarcMember
+from link_copy import save_json, is_temp_path
+
+MANIFEST_VERSION = 1
+
+MANIFEST_SUFFIX = ".manifest.json"
+JOURNAL_SUFFIX = ".journal.jsonl"
+
+def get_manifest_path(output_folder):
+    return os.path.normpath(os.path.abspath(output_folder)) + MANIFEST_SUFFIX
+
+def get_journal_path(output_folder):
+    return os.path.normpath(os.path.abspath(output_folder)) + JOURNAL_SUFFIX
+
+def is_run_file(file_name):
+    """
+    True for the bookkeeping of a run rather than game data: manifests, journals and the temporary files of
+    unfinished writes. With the per-folder steps of the README they end up inside the folder that is packed
+    """
+    return file_name.endswith(MANIFEST_SUFFIX) or file_name.endswith(JOURNAL_SUFFIX) or is_temp_path(file_name)
+
+def get_input_signature(input_paths):
+    """
+    Signature of a list of input files: their path, size and modification time.
+    Files inside archives (psarc.PsarcMember) are signed with the size and modification time of their archive
+    """
+    signature = []
+    for input_path in input_paths:
+        if isinstance(input_path, PsarcMember):
+            # members change along with their archive
+            stat = os.stat(input_path.archive_path)
+            signature.append([f"{os.path.abspath(input_path.archive_path)}::{input_path.name}", stat.st_size, stat.st_mtime_ns])
+        else:
+            stat = os.stat(input_path)
+            signature.append([os.path.abspath(input_path), stat.st_size, stat.st_mtime_ns])
+    return signature
+
+class UndubManifest:
+    """
+    Manifest of the files in an output folder, keyed by their path relative to the folder
+    """
+    def __init__(self, output_folder, algorithm_version):
+        self.output_folder = os.path.abspath(output_folder)
+        self.manifest_path = get_manifest_path(output_folder)
+        self.journal_path = get_journal_path(output_folder)
+        self.journal = None # opened on the first record
+        self.algorithm_version = algorithm_version
+        self.entries = {}
+
+        if os.path.isfile(self.manifest_path):
+            try:
+                with open(self.manifest_path, "r") as manifest_file:
+                    manifest = json.load(manifest_file)
+            except ValueError:
+                print(f"Ignoring unreadable manifest {self.manifest_path}")
+                manifest = {}
+
+            if manifest.get("version") == MANIFEST_VERSION:
+                self.entries = manifest.get("files", {})
+
+        self.n_journaled = self.replay_journal()
+
+    def replay_journal(self):
+        """
+        Applies the journal left by a run that did not get to save the manifest. Returns the number of files replayed
+        """
+        if not os.path.isfile(self.journal_path):
+            return 0
+
+        n_replayed = 0
+        with open(self.journal_path, "r") as journal:
+            for line in journal:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the last line is cut short when the run died while writing it
+                    continue
+
+                if not record.get("version") == MANIFEST_VERSION:
+                    continue
+                if record["entry"] is None:
+                    self.entries.pop(record["file"], None)
+                else:
+                    self.entries[record["file"]] = record["entry"]
+                n_replayed += 1
+        
+        print(f"Replayed {n_replayed} files from the journal of an interrupted run ({self.journal_path})")
+        return n_replayed
+
+    def append_journal(self, key, entry):
+        """
+        Appends a recorded (or, with an entry of None, forgotten) file to the journal, flushed to the OS at once
+        """
+        if self.journal is None:
+            self.journal = open(self.journal_path, "a")
+        self.journal.write(json.dumps({"version": MANIFEST_VERSION, "file": key, "entry": entry}) + "\n")
+        self.journal.flush()
+
+    def get_key(self, output_file):
+        return os.path.relpath(os.path.abspath(output_file), self.output_folder).replace(os.sep, "/")
+
+    def is_current(self, output_file, signature):
+        """
+        True if output_file exists as it was last written, from the same inputs and with the same algorithm
+        """
+        entry = self.entries.get(self.get_key(output_file))
+        if entry is None:
+            return False
+
+        if not entry["algorithm"] == self.algorithm_version or not entry["inputs"] == signature:
+            return False
+
+        try:
+            return os.path.getsize(output_file) == entry["size"]
+        except OSError:
+            return False
+
+    def record(self, output_file, signature):
+        key = self.get_key(output_file)
+        self.entries[key] = {
+            "inputs": signature,
+            "algorithm": self.algorithm_version,
+            "size": os.path.getsize(output_file),
+        }
+        self.append_journal(key, self.entries[key])
+
+    def forget(self, output_file):
+        key = self.get_key(output_file)
+        if self.entries.pop(key, None) is not None:
+            self.append_journal(key, None)
+
+    def save(self):
+        save_json(self.manifest_path, {"version": MANIFEST_VERSION, "files": self.entries}, sort_keys=True)
+
+        # everything journaled is in the manifest now
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        if os.path.isfile(self.journal_path):
+            os.remove(self.journal_path)
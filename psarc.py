@@ -0,0 +1,508 @@
+"""
+PSARC Reading and Writing
+
+Reads PlayStation ARChives (version 1.4, zlib compression) as used by mgs3.psarc and mgs3_jp.psarc,
+so files can be read straight out of the archives without extracting them to disk first.
+Entries are decompressed lazily, one block at a time, as they are read.
+
+Also packs folders back into archives the game accepts (version 1.4, zlib, absolute path names),
+compressing blocks across a pool of worker processes.
+
+Archive layout (all big-endian):
+    Header (32 bytes): MAGIC VERSION_MAJOR VERSION_MINOR COMPRESSION TOC_LENGTH TOC_ENTRY_SIZE TOC_ENTRIES BLOCK_SIZE FLAGS
+    TOC entries (30 bytes each): NAME_MD5 FIRST_BLOCK UNCOMPRESSED_SIZE(40 bit) OFFSET(40 bit)
+    Block size table: stored size of every block, 0 meaning a full uncompressed block
+    Data blocks, each either zlib compressed or stored as is
+The first TOC entry is the manifest, the newline separated names of all the other entries.
+"""
+import io
+import os
+import zlib
+import struct
+import hashlib
+import collections
+
+PSARC_MAGIC = b"PSAR"
+
+HEADER = struct.Struct(">4sHH4sIIIII")
+TOC_ENTRY = struct.Struct(">16sI5s5s")
+
+FLAG_IGNORE_CASE = 0x1
+FLAG_ABSOLUTE_PATHS = 0x2
+
+DEFAULT_BLOCK_SIZE = 0x10000
+SEGMENT_BLOCKS = 64 # blocks compressed per worker task
+SEGMENTS_IN_FLIGHT_PER_JOB = 2 # segments handed to the pool ahead of the writer, per worker process
+
+def get_block_size_width(block_size):
+    """
+    Number of bytes used per entry of the block size table
+    """
+    if block_size <= 0x10000:
+        return 2
+    elif block_size <= 0x1000000:
+        return 3
+    else:
+        return 4
+
+def get_u40_be(buf):
+    return int.from_bytes(buf, "big")
+
+def is_zlib_block(stored):
+    """
+    Whether a block starts with a zlib header (deflate, with a valid header checksum). Packers store blocks that
+    compression could not shrink as is, but some keep a zlib block no smaller than its data, so the size alone
+    does not tell a compressed block from a raw one
+    """
+    return len(stored) >= 2 and stored[0] & 0x0F == 8 and ((stored[0] << 8) | stored[1]) % 31 == 0
+
+PsarcEntry = collections.namedtuple("PsarcEntry", ["index", "name", "name_md5", "first_block", "size", "offset"])
+
+class PsarcArchive:
+    """
+    PSARC archive opened for reading
+    """
+    def __init__(self, psarc_path):
+        self.psarc_path = os.path.abspath(psarc_path)
+        self.file = open(self.psarc_path, "rb")
+
+        header = self.file.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise Exception(f"{psarc_path} is too small to be a PSARC file")
+
+        (magic, self.version_major, self.version_minor, compression, self.toc_length,
+         self.toc_entry_size, n_entries, self.block_size, self.flags) = HEADER.unpack(header)
+
+        if not magic == PSARC_MAGIC:
+            raise Exception(f"{psarc_path} is not a PSARC file")
+
+        self.compression = compression.decode("ascii")
+        if not self.compression == "zlib":
+            raise Exception(f"{psarc_path}: unsupported PSARC compression {self.compression}")
+
+        if self.toc_entry_size < TOC_ENTRY.size:
+            raise Exception(f"{psarc_path}: unsupported TOC entry size {self.toc_entry_size}")
+
+        toc = self.file.read(self.toc_length - HEADER.size)
+
+        # table of contents
+        entries = []
+        for i in range(n_entries):
+            name_md5, first_block, size, offset = TOC_ENTRY.unpack_from(toc, i * self.toc_entry_size)
+            entries.append((name_md5, first_block, get_u40_be(size), get_u40_be(offset)))
+
+        # block size table, fills the rest of the TOC
+        width = get_block_size_width(self.block_size)
+        table_start = n_entries * self.toc_entry_size
+        self.block_sizes = [
+            int.from_bytes(toc[position:position + width], "big")
+            for position in range(table_start, len(toc) - width + 1, width)
+        ]
+
+        # the manifest (entry 0) names every other entry
+        self.entries = []
+        self.entries_by_name = {}
+        if entries:
+            manifest_entry = PsarcEntry(0, None, *entries[0])
+            names = self.read_entry(manifest_entry).decode("utf-8").split("\n")
+
+            for i, (name_md5, first_block, size, offset) in enumerate(entries[1:], 1):
+                name = names[i - 1] if i - 1 < len(names) else f"_unnamed_{i}"
+                entry = PsarcEntry(i, name, name_md5, first_block, size, offset)
+                self.entries.append(entry)
+                self.entries_by_name[self.get_name_key(name)] = entry
+
+    def get_name_key(self, name):
+        if self.flags & FLAG_IGNORE_CASE:
+            return name.lower()
+        return name
+
+    def get_names(self):
+        return [entry.name for entry in self.entries]
+
+    def get_entry(self, name):
+        entry = self.entries_by_name.get(self.get_name_key(name))
+        if entry is None:
+            raise Exception(f"{name} not found in {self.psarc_path}")
+        return entry
+
+    def get_block_lengths(self, entry):
+        """
+        Uncompressed length of every block of an entry
+        """
+        n_full_blocks, remainder = divmod(entry.size, self.block_size)
+        lengths = [self.block_size] * n_full_blocks
+        if remainder:
+            lengths.append(remainder)
+        return lengths
+
+    def get_block_offsets(self, entry):
+        """
+        Absolute offset of every block of an entry in the archive
+        """
+        block_offsets = []
+        offset = entry.offset
+        for i in range(len(self.get_block_lengths(entry))):
+            block_offsets.append(offset)
+            offset += self.block_sizes[entry.first_block + i] or self.block_size
+        return block_offsets
+
+    def iter_raw_blocks(self, entry, file=None):
+        """
+        Yields (stored bytes, uncompressed length) for every block of an entry, without decompressing them
+        """
+        file = file or self.file
+        file.seek(entry.offset)
+        for i, length in enumerate(self.get_block_lengths(entry)):
+            stored_size = self.block_sizes[entry.first_block + i]
+            if stored_size == 0:
+                stored_size = self.block_size
+            yield file.read(stored_size), length
+
+    def read_entry(self, entry):
+        return b"".join(decompress_block(stored, length) for stored, length in self.iter_raw_blocks(entry))
+
+    def read(self, name):
+        return self.read_entry(self.get_entry(name))
+
+    def open(self, name):
+        """
+        Opens an entry as a seekable, buffered binary file, decompressing blocks on demand
+        """
+        return io.BufferedReader(PsarcEntryFile(self, self.get_entry(name)), buffer_size=self.block_size)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def decompress_block(stored, length):
+    """
+    Uncompressed data of a stored block of length bytes: blocks with a zlib header are decompressed,
+    and raw blocks (which can happen to start like a zlib header) are recognised by being as big as their data.
+    Raises an Exception when the block is neither, rather than returning data of the wrong length
+    """
+    if is_zlib_block(stored):
+        try:
+            data = zlib.decompress(stored)
+            if len(data) == length:
+                return data
+        except zlib.error:
+            pass
+    
+    if len(stored) == length:
+        return stored
+    raise Exception(f"corrupt PSARC block: {len(stored)} stored bytes are neither a zlib stream nor raw data of {length} bytes")
+
+class PsarcEntryFile(io.RawIOBase):
+    """
+    Raw, seekable reader over a single archive entry. Keeps one decompressed block cached,
+    and has its own handle on the archive so several entries can be read at once
+    """
+    def __init__(self, archive, entry):
+        self.archive = archive
+        self.entry = entry
+        self.file = open(archive.psarc_path, "rb")
+        self.name = entry.name
+        self.position = 0
+
+        self.block_offsets = archive.get_block_offsets(entry)
+
+        self.cached_block = None
+        self.cached_data = b""
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.entry.size + offset
+
+        if self.position < 0:
+            raise ValueError("negative seek position")
+        return self.position
+
+    def get_block(self, block):
+        if not block == self.cached_block:
+            block_size = self.archive.block_size
+            stored_size = self.archive.block_sizes[self.entry.first_block + block] or block_size
+            length = min(block_size, self.entry.size - block * block_size)
+
+            self.file.seek(self.block_offsets[block])
+            self.cached_data = decompress_block(self.file.read(stored_size), length)
+            self.cached_block = block
+        return self.cached_data
+
+    def readinto(self, buffer):
+        if self.position >= self.entry.size:
+            return 0
+
+        block, block_offset = divmod(self.position, self.archive.block_size)
+        data = self.get_block(block)[block_offset:block_offset + len(buffer)]
+
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.file.close()
+        super().close()
+
+# a file inside an archive, usable in place of a file path (see smart_file_undub.open_sdt)
+PsarcMember = collections.namedtuple("PsarcMember", ["archive_path", "name"])
+
+open_archives = {} # archives opened by this process, by path
+
+def get_archive(psarc_path):
+    """
+    Opens an archive once per process; parsing the TOC of a large archive is not free
+    """
+    psarc_path = os.path.abspath(psarc_path)
+    if psarc_path not in open_archives:
+        open_archives[psarc_path] = PsarcArchive(psarc_path)
+    return open_archives[psarc_path]
+
+def open_member(member):
+    return get_archive(member.archive_path).open(member.name)
+
+def split_psarc_path(path):
+    """
+    Splits a path that goes into an archive (e.g. mgs3_jp.psarc/jp/vox) into the archive path and the
+    absolute folder name inside it (/jp/vox). Returns None for paths outside of archives
+    """
+    path = os.path.abspath(path)
+    inner_parts = []
+    while True:
+        if os.path.isfile(path) and path.lower().endswith(".psarc"):
+            return path, "/" + "/".join(reversed(inner_parts))
+
+        parent, part = os.path.split(path)
+        if parent == path or not part:
+            return None
+        inner_parts.append(part)
+        path = parent
+
+def walk_archive_folder(psarc_path, folder):
+    """
+    Lists every entry below a folder of an archive as (subdirectory parts relative to the folder, file name, PsarcMember)
+    """
+    archive = get_archive(psarc_path)
+    prefix = [part for part in folder.replace("\\", "/").split("/") if part]
+
+    members = []
+    for entry in archive.entries:
+        parts = [part for part in entry.name.split("/") if part]
+        if len(parts) <= len(prefix) or not archive.get_name_key("/".join(parts[:len(prefix)])) == archive.get_name_key("/".join(prefix)):
+            continue
+        members.append((tuple(parts[len(prefix):-1]), parts[-1], PsarcMember(archive.psarc_path, entry.name)))
+    
+    return members
+
+def compress_block(data, ratio):
+    """
+    zlib compresses a block, keeping it as is when compression does not make it smaller
+    """
+    compressed = zlib.compress(data, ratio)
+    if len(compressed) >= len(data):
+        return data
+    return compressed
+
+def compress_segment(task):
+    """
+    Reads and compresses a run of blocks of a file. Returns the stored bytes of every block
+    and how many of them were reused from the original archive.
+    When the task names an entry of an original archive (reuse), every block whose bytes are identical
+    to the same block of that entry is copied over still compressed, instead of being compressed again
+    """
+    file_path, offset, length, block_size, ratio, reuse = task
+    with open(file_path, "rb") as file:
+        file.seek(offset)
+        data = file.read(length)
+    
+    original_blocks = []
+    original_lengths = []
+    if reuse is not None:
+        original = get_archive(reuse[0])
+        entry = original.get_entry(reuse[1])
+
+        first_block = offset // block_size
+        n_blocks = (length + block_size - 1) // block_size
+        block_offsets = original.get_block_offsets(entry)[first_block:first_block + n_blocks]
+
+        # a handle of our own, the archive's may be shared with other worker processes
+        with open(original.psarc_path, "rb") as original_file:
+            original_file.seek(block_offsets[0])
+            for i in range(len(block_offsets)):
+                stored_size = original.block_sizes[entry.first_block + first_block + i] or block_size
+                original_blocks.append(original_file.read(stored_size))
+                original_lengths.append(min(block_size, entry.size - (first_block + i) * block_size))
+
+    stored_blocks = []
+    n_reused = 0
+    for i, start in enumerate(range(0, len(data), block_size)):
+        block = data[start:start + block_size]
+        # blocks of another length (the last block of a file that grew or shrank) cannot match
+        if i < len(original_blocks) and original_lengths[i] == len(block) and decompress_block(original_blocks[i], len(block)) == block:
+            stored_blocks.append(original_blocks[i])
+            n_reused += 1
+        else:
+            stored_blocks.append(compress_block(block, ratio))
+    
+    return stored_blocks, n_reused
+
+def imap_bounded(pool, function, tasks, window):
+    """
+    Like pool.imap, results in order, but with at most window tasks handed to the pool and not yet taken back,
+    so results cannot pile up in this process when the workers outrun whoever consumes them
+    """
+    pending = collections.deque()
+    for task in tasks:
+        pending.append(pool.apply_async(function, (task,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    
+    while pending:
+        yield pending.popleft().get()
+
+def list_pack_files(folder, skip_file=None):
+    """
+    Lists (archive name, file path) for every file below a folder, with names sorted and relative to the folder.
+    Files whose name skip_file returns True for are left out
+    """
+    files = []
+    for dir_path, dir_names, file_names in os.walk(folder):
+        for file_name in file_names:
+            if skip_file is not None and skip_file(file_name):
+                print(f"\tNot packing {os.path.join(dir_path, file_name)}")
+                continue
+            file_path = os.path.join(dir_path, file_name)
+            name = os.path.relpath(file_path, folder).replace(os.sep, "/")
+            files.append((name, file_path))
+    
+    files.sort()
+    return files
+
+def pack_folder(folder, psarc_path, jobs=1, ratio=9, block_size=DEFAULT_BLOCK_SIZE, absolute_paths=True, reuse_psarc_path=None, skip_file=None):
+    """
+    Packs every file below a folder into a PSARC 1.4 archive with zlib compression,
+    the same settings the Total Commander PSARC plugin is used with (ratio 9, absolute path names).
+    Blocks are compressed in runs of SEGMENT_BLOCKS across a pool of jobs worker processes and written
+    in order behind a reserved TOC, which is filled in once every block size is known.
+    With reuse_psarc_path (the original mgs3.psarc), blocks of files left unchanged by the undub are copied
+    from the original archive still compressed, so only modified data is compressed again.
+    Files whose name skip_file returns True for are not packed.
+    Returns the number of packed files
+    """
+    files = list_pack_files(folder, skip_file)
+    if absolute_paths:
+        names = ["/" + name for name, file_path in files]
+        flags = FLAG_ABSOLUTE_PATHS
+    else:
+        names = [name for name, file_path in files]
+        flags = 0
+    
+    manifest = "\n".join(names).encode("utf-8")
+    sizes = [len(manifest)] + [os.path.getsize(file_path) for name, file_path in files]
+
+    # the TOC size only depends on the number of blocks, so it can be reserved up front
+    n_blocks = sum((size + block_size - 1) // block_size for size in sizes)
+    width = get_block_size_width(block_size)
+    toc_length = HEADER.size + TOC_ENTRY.size * len(sizes) + width * n_blocks
+
+    original = None
+    if reuse_psarc_path is not None:
+        original = get_archive(reuse_psarc_path)
+        if not original.block_size == block_size:
+            print(f"Not reusing blocks of {reuse_psarc_path}, it uses a different block size ({original.block_size})")
+            original = None
+
+    tasks = []
+    for name, (archive_name, file_path), size in zip(names, files, sizes[1:]):
+        # only entries of the same size can be unchanged
+        reuse = None
+        if original is not None:
+            entry = original.entries_by_name.get(original.get_name_key(name))
+            if entry is not None and entry.size == size:
+                reuse = (original.psarc_path, entry.name)
+
+        segment_length = SEGMENT_BLOCKS * block_size
+        for offset in range(0, size, segment_length):
+            tasks.append((file_path, offset, min(segment_length, size - offset), block_size, ratio, reuse))
+
+    entry_offsets = []
+    entry_first_blocks = []
+    block_sizes = []
+    n_reused_blocks = 0
+
+    with open(psarc_path, "wb") as psarc:
+        psarc.write(b"\0" * toc_length)
+        
+        def write_blocks(stored_blocks):
+            for stored in stored_blocks:
+                psarc.write(stored)
+                block_sizes.append(len(stored) if len(stored) < block_size else 0)
+
+        # manifest
+        entry_offsets.append(psarc.tell())
+        entry_first_blocks.append(0)
+        write_blocks([compress_block(manifest[start:start + block_size], ratio) for start in range(0, len(manifest), block_size)])
+
+        if jobs > 1:
+            # only packing needs worker processes, readers of the archives should not pay for the import
+            import multiprocessing
+            pool = multiprocessing.Pool(jobs)
+            # the single writer sets the pace, e.g. reused blocks are only compared and come back much faster than they are written
+            segments = imap_bounded(pool, compress_segment, tasks, SEGMENTS_IN_FLIGHT_PER_JOB * jobs)
+        else:
+            pool = None
+            segments = map(compress_segment, tasks)
+
+        try:
+            for (name, file_path), size in zip(files, sizes[1:]):
+                entry_offsets.append(psarc.tell())
+                entry_first_blocks.append(len(block_sizes))
+
+                # every segment of a file comes out in order
+                n_segments = (size + SEGMENT_BLOCKS * block_size - 1) // (SEGMENT_BLOCKS * block_size)
+                for i in range(n_segments):
+                    stored_blocks, n_reused = next(segments)
+                    write_blocks(stored_blocks)
+                    n_reused_blocks += n_reused
+                
+                if len(entry_offsets) % 1000 == 0:
+                    print(f"\tPacked {len(entry_offsets) - 1}/{len(files)} files")
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+        # fill in the header and TOC
+        psarc.seek(0)
+        psarc.write(HEADER.pack(PSARC_MAGIC, 1, 4, b"zlib", toc_length, TOC_ENTRY.size, len(sizes), block_size, flags))
+        for i, size in enumerate(sizes):
+            if i == 0:
+                name_md5 = b"\0" * 16 # the manifest has no name
+            else:
+                name_md5 = hashlib.md5(names[i - 1].encode("utf-8")).digest()
+            psarc.write(TOC_ENTRY.pack(name_md5, entry_first_blocks[i], size.to_bytes(5, "big"), entry_offsets[i].to_bytes(5, "big")))
+        for stored_size in block_sizes:
+            psarc.write(stored_size.to_bytes(width, "big"))
+    
+    print(f"\tPacked {len(files)}/{len(files)} files")
+    if reuse_psarc_path is not None:
+        print(f"\tReused {n_reused_blocks}/{len(block_sizes)} compressed blocks from {reuse_psarc_path}")
+    return len(files)
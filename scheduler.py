@@ -0,0 +1,226 @@
+"""
+Work Scheduler
+
+Orders the work of a parallel undub run so the workers finish together. Every work item is given a cost from the
+sizes of its input files, then the items are dispatched largest first (longest processing time first, LPT), so a
+giant movie file is never left for last while the other workers sit idle. Small files are grouped into batches,
+so thousands of tiny vox files do not each pay for a round trip to a worker process.
+
+The schedule predicts its makespan (the time until the last worker is done) by assigning the batches in order
+to the least loaded worker; once the run is done, the prediction is compared with what actually happened.
+
+With a memory budget, every file also gets an estimated memory footprint, and files too big for their share of
+the budget are stitched in the constant memory stream mode instead. A MemoryBudget then admits new work only
+while the footprint of everything in flight stays under the budget.
+"""
+import heapq
+import threading
+from psarc import PsarcMember
+from undub_plan import get_input_size
+
+FILE_COST = 64 * 1024 # fixed cost of any file, in bytes read: opening, peeking, linking, reporting
+
+BATCH_COST = 16 * 1024 * 1024 # files cheaper than this are batched together, up to this cost per batch
+MAX_BATCH_FILES = 256
+
+BATCHES_PER_JOB = 4 # batches are kept small enough that every worker gets at least this many
+
+FILE_FOOTPRINT = 1024 * 1024 # memory used by files that are not held in memory: buffers, section tables
+LOW_MEMORY_MODE = "stream" # stitch mode of files too big for their share of the memory budget
+
+def parse_memory_size(text):
+    """
+    Memory size from a command line: bytes, or a number with a K, M or G suffix (e.g. 512M, 4G)
+    """
+    text = text.strip().upper().rstrip("B")
+    multiplier = 1
+    if text and text[-1] in "KMG":
+        multiplier = 1024 ** ("KMG".index(text[-1]) + 1)
+        text = text[:-1]
+    return int(float(text) * multiplier)
+
+def estimate_footprint(item, stitch_mode="memory"):
+    """
+    Peak memory of undubbing a (japanese_file, us_file, output_file) work item in a stitch mode, in bytes.
+    The memory mode holds both inputs and the output, which is about as big as the larger input;
+    the mmap mode only maps files, but reads files inside archives into memory
+    """
+    japanese_file, us_file, output_file = item
+    if japanese_file is None or stitch_mode == "stream":
+        return FILE_FOOTPRINT
+    
+    if stitch_mode == "mmap":
+        return FILE_FOOTPRINT + sum(get_input_size(input_file) for input_file in (japanese_file, us_file) if isinstance(input_file, PsarcMember))
+
+    japanese_size = get_input_size(japanese_file)
+    us_size = get_input_size(us_file)
+    return FILE_FOOTPRINT + japanese_size + us_size + max(japanese_size, us_size)
+
+def choose_stitch_mode(item, stitch_mode="memory", max_memory=None, jobs=1):
+    """
+    Stitch mode and estimated footprint of a work item under a memory budget shared by jobs workers:
+    files whose footprint is over their share of max_memory fall back to the low memory stream mode
+    """
+    try:
+        footprint = estimate_footprint(item, stitch_mode)
+    except OSError:
+        # missing inputs fail as soon as they are undubbed
+        return stitch_mode, FILE_FOOTPRINT
+    
+    if max_memory is not None and footprint > max_memory // max(1, jobs):
+        return LOW_MEMORY_MODE, estimate_footprint(item, LOW_MEMORY_MODE)
+    return stitch_mode, footprint
+
+class MemoryBudget:
+    """
+    Bytes of memory shared by the work in flight. Work is admitted while its footprint fits in what is left,
+    and work bigger than the whole budget is still admitted on its own, once nothing else is in flight
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.peak = 0
+        self.condition = threading.Condition()
+
+    def fits(self, n_bytes):
+        return self.used == 0 or self.used + n_bytes <= self.max_bytes
+
+    def try_acquire(self, n_bytes):
+        with self.condition:
+            if not self.fits(n_bytes):
+                return False
+            self.used += n_bytes
+            self.peak = max(self.peak, self.used)
+            return True
+
+    def acquire(self, n_bytes):
+        with self.condition:
+            self.condition.wait_for(lambda: self.fits(n_bytes))
+            self.used += n_bytes
+            self.peak = max(self.peak, self.used)
+
+    def release(self, n_bytes):
+        with self.condition:
+            self.used -= n_bytes
+            self.condition.notify_all()
+
+def estimate_cost(item):
+    """
+    Cost of a (japanese_file, us_file, output_file) work item, in bytes read. Stitched files read both inputs
+    whole; files passed through are linked where the filesystem allows, so they only cost the fixed cost
+    """
+    japanese_file, us_file, output_file = item
+    if japanese_file is None:
+        return FILE_COST
+    return FILE_COST + get_input_size(japanese_file) + get_input_size(us_file)
+
+def predict_loads(costs, jobs):
+    """
+    Load of every worker when costs are handed out in order, each to the least loaded worker
+    """
+    loads = [(0, worker) for worker in range(max(1, jobs))]
+    for cost in costs:
+        load, worker = heapq.heappop(loads)
+        heapq.heappush(loads, (load + cost, worker))
+    return [load for load, worker in sorted(loads, key=lambda load: load[1])]
+
+class WorkSchedule:
+    """
+    Work items in batches, in the order they are dispatched, with their predicted and (once run) actual loads.
+    Batches are lists of (work item, stitch mode): the stitch_mode of the run, or the low memory mode for files
+    too big for their share of max_memory. The footprint of a batch is that of its biggest file, as a worker
+    undubs the files of a batch one at a time
+    """
+    def __init__(self, work, jobs, batch_cost=BATCH_COST, stitch_mode="memory", max_memory=None):
+        self.jobs = max(1, jobs)
+        self.max_memory = max_memory
+        costs = {}
+        modes = {}
+        footprints = {}
+        for item in work:
+            try:
+                costs[item] = estimate_cost(item)
+            except OSError:
+                # missing inputs fail as soon as they are undubbed, which is cheap
+                costs[item] = FILE_COST
+            modes[item], footprints[item] = choose_stitch_mode(item, stitch_mode, max_memory, self.jobs)
+        self.total_cost = sum(costs.values())
+        self.n_low_memory_files = sum(1 for item in work if not modes[item] == stitch_mode)
+
+        # enough batches to go around, even for small trees
+        batch_cost = max(FILE_COST, min(batch_cost, self.total_cost // (self.jobs * BATCHES_PER_JOB)))
+
+        self.batches = []
+        self.batch_costs = []
+        batch = []
+        batch_total = 0
+        for item in sorted(work, key=lambda item: -costs[item]):
+            if costs[item] >= batch_cost:
+                self.batches.append([item])
+                self.batch_costs.append(costs[item])
+                continue
+
+            batch.append(item)
+            batch_total += costs[item]
+            if batch_total >= batch_cost or len(batch) >= MAX_BATCH_FILES:
+                self.batches.append(batch)
+                self.batch_costs.append(batch_total)
+                batch = []
+                batch_total = 0
+        if batch:
+            self.batches.append(batch)
+            self.batch_costs.append(batch_total)
+
+        # largest first
+        order = sorted(range(len(self.batches)), key=lambda i: -self.batch_costs[i])
+        self.batches = [[(item, modes[item]) for item in self.batches[i]] for i in order]
+        self.batch_costs = [self.batch_costs[i] for i in order]
+        self.batch_footprints = [max(footprints[item] for item, mode in batch) for batch in self.batches]
+        self.peak_memory = None # peak footprint in flight, once run under a MemoryBudget
+        self.predicted_loads = predict_loads(self.batch_costs, self.jobs)
+
+        self.worker_seconds = {} # busy seconds of every worker process that ran batches, by pid
+        self.seconds = None
+
+    def get_n_files(self):
+        return sum(len(batch) for batch in self.batches)
+
+    def add_batch_result(self, worker, seconds):
+        self.worker_seconds[worker] = self.worker_seconds.get(worker, 0.0) + seconds
+
+    def to_dict(self):
+        """
+        The prediction, and how it went once seconds (the wall time of the run) is set.
+        Predicted seconds scale the predicted loads by the measured seconds per cost of the whole run
+        """
+        predicted_makespan = max(self.predicted_loads) if self.predicted_loads else 0
+        schedule = {
+            "jobs": self.jobs,
+            "n_files": self.get_n_files(),
+            "n_batches": len(self.batches),
+            "total_cost": self.total_cost,
+            "predicted_makespan_cost": predicted_makespan,
+            "predicted_balance": predicted_makespan * self.jobs / self.total_cost if self.total_cost else None,
+            "max_memory": self.max_memory,
+            "n_low_memory_files": self.n_low_memory_files,
+            "peak_memory": self.peak_memory,
+        }
+
+        if self.seconds is not None:
+            busy_seconds = sum(self.worker_seconds.values())
+            schedule["seconds"] = self.seconds
+            schedule["predicted_seconds"] = busy_seconds * predicted_makespan / self.total_cost if self.total_cost else None
+            schedule["worker_seconds"] = sorted(self.worker_seconds.values(), reverse=True)
+            schedule["actual_balance"] = max(self.worker_seconds.values()) * self.jobs / busy_seconds if busy_seconds else None
+
+        return schedule
+
+    def print_summary(self):
+        schedule = self.to_dict()
+        print(f"Scheduled {schedule['n_files']} files in {schedule['n_batches']} batches over {self.jobs} workers, largest first")
+        if self.max_memory is not None:
+            print(f"\tMemory budget of {self.max_memory} bytes: {self.n_low_memory_files} files stitched in the {LOW_MEMORY_MODE} mode, "
+                  f"estimated peak {self.peak_memory} bytes in flight")
+        if self.seconds is not None and schedule["predicted_seconds"] is not None:
+            print(f"\tMakespan: predicted {schedule['predicted_seconds']:.2f}s (balance {schedule['predicted_balance']:.2f}), "
+                  f"actual {self.seconds:.2f}s (balance {schedule['actual_balance'] or 0:.2f})")
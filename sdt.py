@@ -0,0 +1,618 @@
+"""
+SDT Format
+
+Everything about the .sdt container shared by the undubbing scripts and the debug tools:
+header decoding, the stream extension map, stream kinds, parsers (whole files, header-only scans,
+memory maps and header tables) and writers.
+
+A .sdt is a sequence of sections, each starting with a 16 byte little-endian header:
+ID SIZE X STREAM_ID
+    0x10 headers register a stream (its ID in field 0x0C), before any of its data
+    data sections have the ID of their stream and SIZE counts the header; field 0x0C is a block index, 0 for padding
+    an 0xF0 header ends the file
+
+Written by Matthew Tran (giantlightbulb@gmail.com) with substantial reference to AnonRunzes's
+sdt_demux.py
+"""
+import io
+import os
+import mmap
+import array
+import struct
+import functools
+import itertools
+from psarc import PsarcMember, open_member
+from instrumentation import stage, count_read, count_written, count_sections
+
+# most buffers handed to a single os.writev call
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = -1
+if IOV_MAX <= 0:
+    IOV_MAX = 1024
+
+U32_LE = struct.Struct("<I")
+HEADER = struct.Struct("<IIII") # ID SIZE X STREAM_ID
+
+def get_u32_le(buf, offset):
+    return struct.unpack("<I", buf[offset:offset+4])[0]
+
+def put_u32_le(buf, offset, n):
+    buf[offset:offset+4] = struct.pack("<I", n)
+
+extmap = {
+    0x00000001: ".genh",   # ADPCM -> GENH / ".sdx_0"
+    0x00000002: ".dmx",    # this container was found on Zone of the Enders HD Remaster
+    0x00000003: ".nrm",
+    0x00000004: ".pacb",   # has "PACB" magic not seen in any of the original versions the HD remaster was based on
+    0x00000005: ".dmx",    # ditto
+    0x00000006: ".bpx",    
+    0x0000000c: ".pac",    # XBOX version of MGS2 - MPEG2 video format
+    0x0000000d: ".pac",    # XBOX version of MGS2 - MPEG2 video format
+    0x0000000e: ".pss",    # PS2 version of MGS2 - MPEG2 video format
+    0x0000000f: ".ipu",    # PS2 version of MGS2 - MPEG2 video format
+    0x00000020: ".m2v",    # this container is present even on all versions of the HD remaster(PS3, XBOX360, PSVITA), regardless of format
+    0x00010001: ".sdx_1",
+    0x00010004: ".sub_en", # it's a made-up container, becuase in the executable of those Metal Gear Solid PS2 games there's no indication of a container used for these formats
+    0x00020001: ".sdx_2",
+    0x00020004: ".sub_fr", # ditto
+    0x00030001: ".msf",    # PS3 HD remaster audio format
+    0x00030004: ".sub_de", # ditto
+    0x00040001: ".xwma",   # XBOX360 HD remaster audio format
+    0x00040004: ".sub_it", # ditto
+    0x00050001: ".9tav",   # PSVITA HD remaster audio format
+    0x00050004: ".sub_es", # ditto
+    0x00060004: ".sub_jp", # ditto
+    0x00070004: ".sub_jp", # ditto
+    0x00100001: ".vag",    # VAG1/VAG2 format
+    0x00110001: ".mtaf",   # MTAF format
+
+    #0x00000002: ".xxxx",
+    #0x00000005: ".xxxx",
+    #0x00010006: ".xxxx",
+    #0x00020006: ".xxxx",
+    #0x00030006: ".xxxx",
+    #0x00040006: ".xxxx",
+    #0x00050006: ".xxxx",
+    #0x00070006: ".xxxx",
+}
+
+KIND_AUDIO = "audio"
+KIND_VIDEO = "video"
+KIND_SUBTITLE = "subtitle"
+KIND_LIP_SYNC = "lip sync"
+KIND_OTHER = "other"
+
+extension_kinds = {
+    ".genh": KIND_AUDIO,
+    ".sdx_1": KIND_AUDIO,
+    ".sdx_2": KIND_AUDIO,
+    ".msf": KIND_AUDIO,
+    ".xwma": KIND_AUDIO,
+    ".9tav": KIND_AUDIO,
+    ".vag": KIND_AUDIO,
+    ".mtaf": KIND_AUDIO,
+    ".pac": KIND_VIDEO,
+    ".pss": KIND_VIDEO,
+    ".ipu": KIND_VIDEO,
+    ".m2v": KIND_VIDEO,
+    ".sub_en": KIND_SUBTITLE,
+    ".sub_fr": KIND_SUBTITLE,
+    ".sub_de": KIND_SUBTITLE,
+    ".sub_it": KIND_SUBTITLE,
+    ".sub_es": KIND_SUBTITLE,
+    ".sub_jp": KIND_SUBTITLE,
+    ".bpx": KIND_LIP_SYNC,
+}
+
+# kind of every known stream, looked up once per stream instead of matching extensions
+stream_kinds = {stream_id: extension_kinds.get(extension, KIND_OTHER) for stream_id, extension in extmap.items()}
+
+def get_extension(stream_id):
+    return extmap.get(stream_id, ".bin")
+
+def get_stream_kind(stream_id):
+    """
+    Kind of a stream: KIND_AUDIO, KIND_VIDEO, KIND_SUBTITLE, KIND_LIP_SYNC or KIND_OTHER
+    """
+    return stream_kinds.get(stream_id, KIND_OTHER)
+
+# extensions as small integer codes, so every section's extension is decoded once into an array
+EXTENSIONS = sorted(set(extmap.values()) | {".bin"})
+EXTENSION_CODES = {extension: code for code, extension in enumerate(EXTENSIONS)}
+STREAM_EXTENSION_CODES = {stream_id: EXTENSION_CODES[extension] for stream_id, extension in extmap.items()}
+BIN_EXTENSION_CODE = EXTENSION_CODES[".bin"]
+
+class Section:
+    """
+    Section of a .sdt file, with its header fields decoded once
+    """
+    __slots__ = ("header", "data", "header_id", "size", "field_08", "stream_id", "extension")
+
+    def __init__(self, header, data):
+        self.header = header
+        self.data = data
+
+        if len(header) < 16:
+            # truncated files can end on a partial header
+            header = bytes(header).ljust(16, b"\0")
+        self.header_id, self.size, self.field_08, self.stream_id = HEADER.unpack(header)
+
+        if self.header_id == 0x10:
+            self.extension = get_extension(self.stream_id)
+        else:
+            self.extension = get_extension(self.header_id)
+    
+    def get_header_id(self):
+        return self.header_id
+    
+    def get_stream_id(self):
+        return self.stream_id
+    
+    def get_size(self):
+        return self.size - 16
+    
+    def get_extension(self):
+        return self.extension
+    
+    def to_bytes(self):
+        if self.data:
+            return self.header + self.data
+        else:
+            return self.header
+
+class SectionTable:
+    """
+    Headers of all the sections of a .sdt file, decoded once into flat arrays with one entry per section:
+    offset, on-disk length, the four header fields (ID SIZE X STREAM_ID) and an extension code (see EXTENSIONS).
+    Stitches are planned on these arrays (see smart_file_undub.plan_stitch_ranges) without a Python object per section
+    """
+    def __init__(self, sdt_size=0):
+        self.sdt_size = sdt_size
+        self.offsets = array.array("Q")
+        self.lengths = array.array("Q")
+        self.header_ids = array.array("I")
+        self.sizes = array.array("I")
+        self.fields_08 = array.array("I")
+        self.stream_ids = array.array("I") # field 0x0C: stream ID for registrations, block index for data
+        self.extension_codes = array.array("B")
+        self.streams = array.array("I") # registered streams, in order
+    
+    def __len__(self):
+        return len(self.offsets)
+    
+    def add_section(self, offset, length, header_id, size, field_08, stream_id):
+        self.offsets.append(offset)
+        self.lengths.append(length)
+        self.header_ids.append(header_id)
+        self.sizes.append(size)
+        self.fields_08.append(field_08)
+        self.stream_ids.append(stream_id)
+
+        if header_id == 0x10:
+            self.streams.append(stream_id)
+            self.extension_codes.append(STREAM_EXTENSION_CODES.get(stream_id, BIN_EXTENSION_CODE))
+        else:
+            self.extension_codes.append(STREAM_EXTENSION_CODES.get(header_id, BIN_EXTENSION_CODE))
+    
+    def update_extension_codes(self):
+        """
+        Recomputes the extension codes from the header fields, e.g. after loading the other arrays from bytes
+        """
+        self.extension_codes = array.array("B", [
+            STREAM_EXTENSION_CODES.get(stream_id if header_id == 0x10 else header_id, BIN_EXTENSION_CODE)
+            for header_id, stream_id in zip(self.header_ids, self.stream_ids)
+        ])
+    
+    def get_extension(self, i):
+        return EXTENSIONS[self.extension_codes[i]]
+    
+    def get_header(self, i):
+        return HEADER.pack(self.header_ids[i], self.sizes[i], self.fields_08[i], self.stream_ids[i])
+    
+    def is_chunk_in(self, start, extension_codes):
+        """
+        True if the chunk starting at section start is data of one of the extension codes, not a stream registration
+        """
+        return self.extension_codes[start] in extension_codes and not self.header_ids[start] == 0x10
+    
+    def get_chunks(self):
+        """
+        Runs of sections with the same header ID as (start, end) section indexes, like chunk_sections
+        """
+        chunks = []
+        start = 0
+        last_header_id = None
+        for header_id, group in itertools.groupby(self.header_ids):
+            end = start + len(list(group))
+            if chunks and not last_header_id:
+                # chunk_sections never closes a chunk after a header ID of 0
+                chunks[-1] = (chunks[-1][0], end)
+            else:
+                chunks.append((start, end))
+            start = end
+            last_header_id = header_id
+        return chunks
+    
+    def get_range(self, start, end):
+        """
+        Byte range (offset, length) of the sections start to end, which are always back to back
+        """
+        offset = self.offsets[start]
+        return offset, self.offsets[end - 1] + self.lengths[end - 1] - offset
+
+def walk_section_headers(sdt, sdt_size, table):
+    """
+    Decodes the headers of all the sections of a .sdt file into table (a SectionTable), one unpack per header,
+    from either a buffer holding the whole file (bytes, memoryview, mmap) or an open binary file, seeking over
+    every payload. The one walk behind decode_sections and scan_section_table, so both follow the same rules
+    as read_in_sections
+    """
+    if isinstance(sdt, (bytes, bytearray, memoryview, mmap.mmap)):
+        unpack_header = functools.partial(HEADER.unpack_from, sdt)
+    else:
+        def unpack_header(offset):
+            sdt.seek(offset)
+            return HEADER.unpack(sdt.read(16))
+    
+    add_section = table.add_section
+    streams = set()
+    offset = 0
+
+    while offset < sdt_size:
+        header_id, size, field_08, stream_id = unpack_header(offset)
+
+        if header_id == 0xF0:
+            # end of file header
+            add_section(offset, 16, header_id, size, field_08, stream_id)
+            break
+        elif header_id == 0x10:
+            # register a new stream
+            if stream_id in streams:
+                print("0x%08X: stream already registered once: %08X" % (offset, stream_id))
+                exit()
+            
+            streams.add(stream_id)
+            add_section(offset, 16, header_id, size, field_08, stream_id)
+            offset += 16
+        elif header_id in streams:
+            # truncated sections end with the file, as a full read would
+            if size >= 16:
+                length = min(size, sdt_size - offset)
+            else:
+                length = sdt_size - offset
+
+            add_section(offset, length, header_id, size, field_08, stream_id)
+            offset += length
+        else:
+            print("0x%08X: unregistered stream / unknown header ID: %08X" % (offset, header_id))
+            exit()
+    
+    return table
+
+def decode_sections(buffer, table=None):
+    """
+    Decodes the headers of all the sections of a .sdt file held in a buffer (bytes, memoryview, mmap)
+    into a SectionTable in a single pass, see walk_section_headers
+    """
+    if table is None:
+        table = SectionTable(len(buffer))
+    
+    return walk_section_headers(buffer, len(buffer), table)
+
+def scan_section_table(sdt_path, table_class=SectionTable):
+    """
+    Decodes the headers of all the sections of a .sdt file at some path into a SectionTable (or a subclass),
+    seeking over every payload, see walk_section_headers
+    """
+    check_sdt_path(sdt_path)
+
+    sdt, sdt_size = open_sdt(sdt_path)
+    table = table_class(sdt_size)
+
+    with stage("parse"), sdt:
+        walk_section_headers(sdt, sdt_size, table)
+        
+        count_read(16 * len(table))
+        count_sections(len(table))
+    
+    return table
+
+def verify_section_table(sdt_path):
+    """
+    Scans the headers of a .sdt file like scan_section_table, seeking over every payload, but checks that the file is
+    well formed instead of stopping at the first problem: every data section belongs to a stream registered before it,
+    no stream is registered twice, every section fits in the file so the sizes add up to the file length, and there is
+    exactly one end of file section, at the very end. The scan goes on past problems for as long as the sizes allow.
+    Returns (SectionTable of the sections that were scanned, [description of every problem])
+    """
+    sdt, sdt_size = open_sdt(sdt_path)
+    table = SectionTable(sdt_size)
+    problems = []
+    streams = set()
+    n_end_sections = 0
+    offset = 0
+
+    with stage("parse"), sdt:
+        while offset < sdt_size:
+            sdt.seek(offset)
+            header = sdt.read(16)
+            if len(header) < 16:
+                problems.append("0x%08X: truncated header, %d bytes left" % (offset, len(header)))
+                break
+            header_id, size, field_08, stream_id = HEADER.unpack(header)
+
+            if header_id == 0xF0:
+                n_end_sections += 1
+                table.add_section(offset, 16, header_id, size, field_08, stream_id)
+                offset += 16
+                if offset < sdt_size and n_end_sections == 1:
+                    problems.append("0x%08X: %d bytes after the end of file section" % (offset, sdt_size - offset))
+            elif header_id == 0x10:
+                if stream_id in streams:
+                    problems.append("0x%08X: stream already registered once: %08X" % (offset, stream_id))
+                streams.add(stream_id)
+                table.add_section(offset, 16, header_id, size, field_08, stream_id)
+                offset += 16
+            else:
+                if header_id not in streams:
+                    problems.append("0x%08X: unregistered stream / unknown header ID: %08X" % (offset, header_id))
+                if size < 16:
+                    problems.append("0x%08X: section size %d is smaller than its header" % (offset, size))
+                    break
+                if offset + size > sdt_size:
+                    problems.append("0x%08X: section of %d bytes runs %d bytes past the end of the file" % (offset, size, offset + size - sdt_size))
+                    break
+                
+                table.add_section(offset, size, header_id, size, field_08, stream_id)
+                offset += size
+        
+        count_read(16 * len(table))
+        count_sections(len(table))
+
+    if n_end_sections == 0:
+        problems.append("no end of file section")
+    elif n_end_sections > 1:
+        problems.append("%d end of file sections" % n_end_sections)
+    
+    return table, problems
+
+class MappedSDT:
+    """
+    Memory maps a .sdt file read-only and decodes its headers into a SectionTable, without copying any payload.
+    Archive members (psarc.PsarcMember) cannot be mapped and are read into memory instead.
+    Use as a context manager; the buffer and sections are only valid until the file is closed.
+    """
+    def __init__(self, sdt_path):
+        check_sdt_path(sdt_path)
+
+        self.sdt_path = sdt_path
+        self.file = None
+        self.map = None
+        
+        if isinstance(sdt_path, PsarcMember):
+            # archive members are compressed, so they can only be read into memory
+            with open_member(sdt_path) as member:
+                self.buffer = memoryview(member.read())
+        else:
+            self.file = open(sdt_path, "rb")
+            if os.fstat(self.file.fileno()).st_size > 0:
+                self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+                self.buffer = memoryview(self.map)
+            else:
+                # empty files cannot be mapped
+                self.buffer = memoryview(b"")
+        
+        with stage("parse"):
+            self.table = decode_sections(self.buffer)
+            # only the headers are read, payloads are paged in as they are written
+            count_read(16 * len(self.table))
+            count_sections(len(self.table))
+        
+        self.streams = list(self.table.streams)
+    
+    def close(self):
+        self.buffer.release()
+        if self.map is not None:
+            self.map.close()
+        if self.file is not None:
+            self.file.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def write_ranges(output_file, ranges):
+    """
+    Writes (buffer, offset, length) byte ranges to an open binary file without copying them,
+    handing them to the kernel in bulk with os.writev where available.
+    Returns the number of bytes written
+    """
+    views = [memoryview(buffer)[offset:offset + length] for buffer, offset, length in ranges]
+    n_bytes = sum(len(view) for view in views)
+    count_read(n_bytes)
+    count_written(n_bytes)
+
+    try:
+        fd = None
+        if hasattr(os, "writev"):
+            try:
+                output_file.flush()
+                fd = output_file.fileno()
+            except (AttributeError, OSError, io.UnsupportedOperation):
+                # not backed by a file descriptor, e.g. io.BytesIO
+                fd = None
+        
+        if fd is None:
+            for view in views:
+                output_file.write(view)
+            return n_bytes
+        
+        index = 0
+        while index < len(views):
+            n_written = os.writev(fd, views[index:index + IOV_MAX])
+
+            # skip everything written, keeping the unwritten part of a partially written view
+            while index < len(views) and n_written >= len(views[index]):
+                n_written -= len(views[index])
+                index += 1
+            if n_written:
+                views[index] = views[index][n_written:]
+        
+        # the kernel moved the file position, not the Python file object's view of it
+        output_file.seek(0, os.SEEK_END)
+        return n_bytes
+    finally:
+        # let the mapped file be closed even if the views outlive this call (e.g. in a traceback)
+        for view in views:
+            view.release()
+
+class SDTWriter:
+    """
+    Writes a .sdt section by section to an open binary file: stream registrations, data sections and the end of file header
+    """
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self.streams = []
+        self.n_written = 0
+    
+    def write_header(self, header_id, size, field_08, stream_id):
+        self.output_file.write(HEADER.pack(header_id, size, field_08, stream_id))
+        self.n_written += 16
+    
+    def register_stream(self, stream_id):
+        if stream_id in self.streams:
+            raise Exception(f"Stream {stream_id:08X} is already registered")
+        self.streams.append(stream_id)
+        self.write_header(0x10, 16, 0, stream_id)
+    
+    def write_section(self, stream_id, data, block_index=0, field_08=0):
+        """
+        Writes a data section of a registered stream; block_index is field 0x0C, 0 for padding
+        """
+        if stream_id not in self.streams:
+            raise Exception(f"Stream {stream_id:08X} is not registered")
+        self.write_header(stream_id, 16 + len(data), field_08, block_index)
+        self.output_file.write(data)
+        self.n_written += len(data)
+    
+    def end(self):
+        self.write_header(0xF0, 16, 0, 0)
+
+def iterate_sections(sdt, sdt_size, streams):
+    """
+    Walks the sections of an open .sdt file, yielding (offset, header, data) for each one.
+    Registered streams are appended to the streams list as they are found.
+    """
+    # iterate over all bytes in the file
+    while (sdt.tell() < sdt_size):
+        offset = sdt.tell()
+        header = sdt.read(16)
+        header_id = get_u32_le(header, 0x00) # what type of header we have
+
+        if header_id == 0xF0:
+            # end of file header
+            yield offset, header, None
+            break
+        elif header_id == 0x10:
+            # register a new stream
+            stream_id = get_u32_le(header, 0x0C)
+
+            # failure state,
+            if stream_id in streams:
+                print("0x%08X: stream already registered once: %08X" % (offset, stream_id))
+                exit()
+            
+            streams.append(stream_id)
+
+            yield offset, header, None
+        elif header_id in streams:
+            # read in header data section
+            size = get_u32_le(header, 0x04) - 16
+            data = sdt.read(size)
+
+            # add the stream data section to the list of sections
+            yield offset, header, data
+        else:
+            print("0x%08X: unregistered stream / unknown header ID: %08X" % (offset, header_id))
+            exit()
+
+
+def check_sdt_path(sdt_path):
+    if isinstance(sdt_path, PsarcMember):
+        name = sdt_path.name
+    elif os.path.isfile(sdt_path):
+        name = sdt_path
+    else:
+        raise Exception(f"{sdt_path} Invalid path for the SDT file")
+    
+    if not os.path.splitext(name)[-1] == ".sdt":
+        raise Exception(f"{sdt_path} is not an SDT file!")
+
+def open_sdt(sdt_path):
+    """
+    Opens a .sdt for reading, either a file on disk or a psarc.PsarcMember read lazily out of its archive.
+    Returns the open binary file and its size
+    """
+    if isinstance(sdt_path, PsarcMember):
+        sdt = open_member(sdt_path)
+    else:
+        sdt = open(sdt_path, "rb")
+    
+    sdt_size = sdt.seek(0, os.SEEK_END)
+    sdt.seek(0)
+    return sdt, sdt_size
+
+def read_in_sections(sdt_path):
+    """
+    Read in all of the sections for a .sdt file at some path
+    """
+    check_sdt_path(sdt_path)
+
+    sections = []
+
+    streams = [] # list of all registered streams
+
+    # open the sdt
+    with stage("parse"):
+        sdt, sdt_size = open_sdt(sdt_path)
+        with sdt:
+            for offset, header, data in iterate_sections(sdt, sdt_size, streams):
+                sections.append(Section(header, data))
+        
+        count_read(sdt_size)
+        count_sections(len(sections))
+    
+    return sections, streams
+
+def chunk_sections(sections):
+    last_header_id = None
+    
+    chunks = []
+    chunk_data = []
+    
+    for section in sections:
+        header_id = section.get_header_id()
+        
+        if not header_id == last_header_id and last_header_id:
+            chunks.append(chunk_data)
+            chunk_data = []
+		
+        chunk_data.append(section)
+        
+        last_header_id = header_id
+    
+    chunks.append(chunk_data)
+    
+    return chunks
+
+def read_sdt_bytes(sdt_path):
+    with stage("read"):
+        sdt, sdt_size = open_sdt(sdt_path)
+        with sdt:
+            count_read(sdt_size)
+            return sdt.read()
+
@@ -0,0 +1,154 @@
+"""
+SDT Indexing
+
+Builds a compact index of the section headers of a .sdt file without reading any payload,
+and caches those indexes on disk so repeated runs never re-scan unchanged files.
+
+An index holds, per section: its offset, on-disk length and the four header fields
+(ID SIZE X STREAM_ID), plus the registered streams and the extension of each stream.
+"""
+import os
+import struct
+import sqlite3
+from psarc import PsarcMember
+from sdt import extmap, SectionTable, scan_section_table
+from instrumentation import stage, count_sections
+
+INDEX_VERSION = 1 # bump whenever the index layout or the scanning rules change
+
+INDEX_HEADER = struct.Struct("<IQII") # version, sdt size, number of sections, number of streams
+
+class SDTIndex(SectionTable):
+    """
+    Header-only index of a .sdt file: a smart_file_undub.SectionTable that can be stored as bytes
+    """
+    def get_extensions(self):
+        """
+        Extension of each registered stream
+        """
+        return {stream_id: extmap.get(stream_id, ".bin") for stream_id in self.streams}
+
+    def to_bytes(self):
+        # extension codes are not stored, they follow extmap
+        parts = [INDEX_HEADER.pack(INDEX_VERSION, self.sdt_size, len(self), len(self.streams))]
+        for values in (self.offsets, self.lengths, self.header_ids, self.sizes, self.fields_08, self.stream_ids, self.streams):
+            parts.append(values.tobytes())
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Loads an index written by to_bytes, or returns None if it was written by another index version
+        """
+        version, sdt_size, n_sections, n_streams = INDEX_HEADER.unpack_from(data, 0)
+        if not version == INDEX_VERSION:
+            return None
+
+        index = cls(sdt_size)
+        offset = INDEX_HEADER.size
+        for values, n_values in ((index.offsets, n_sections), (index.lengths, n_sections), (index.header_ids, n_sections),
+                                 (index.sizes, n_sections), (index.fields_08, n_sections), (index.stream_ids, n_sections),
+                                 (index.streams, n_streams)):
+            n_bytes = n_values * values.itemsize
+            values.frombytes(data[offset:offset + n_bytes])
+            offset += n_bytes
+
+        index.update_extension_codes()
+        return index
+
+def index_sdt(sdt_path):
+    """
+    Scans the section headers of a .sdt file into an SDTIndex, seeking over every payload
+    """
+    return scan_section_table(sdt_path, SDTIndex)
+
+class SDTIndexCache:
+    """
+    On-disk cache of SDTIndexes in a small SQLite database, keyed by absolute path, file size and mtime.
+    Archive members (psarc.PsarcMember) are keyed by archive path and member name, with the size and mtime of the archive.
+    Safe to share between processes; every process opens its own connection. New indexes are kept in memory and
+    written in one short transaction per commit (every commit_every new indexes, or when commit is called),
+    so processes do not queue up on the database lock for every file; the database is in WAL mode,
+    so reading never waits for a process that is writing.
+    """
+    def __init__(self, cache_path, commit_every=256):
+        cache_folder = os.path.dirname(os.path.abspath(cache_path))
+        if not os.path.exists(cache_folder):
+            os.makedirs(cache_folder)
+
+        self.cache_path = cache_path
+        self.commit_every = commit_every
+        self.pending = {} # rows of new indexes not written yet, by path
+        self.n_hits = 0
+        self.n_misses = 0
+
+        self.connection = sqlite3.connect(cache_path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS sdt_index (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, data BLOB)"
+        )
+        self.connection.commit()
+
+    def get(self, sdt_path):
+        """
+        Returns the SDTIndex of a file, scanning it only if it is not cached or changed since it was cached
+        """
+        if isinstance(sdt_path, PsarcMember):
+            path = f"{os.path.abspath(sdt_path.archive_path)}::{sdt_path.name}"
+            stat = os.stat(sdt_path.archive_path)
+        else:
+            path = os.path.abspath(sdt_path)
+            stat = os.stat(path)
+
+        row = self.pending.get(path)
+        if row is None:
+            row = self.connection.execute("SELECT size, mtime_ns, data FROM sdt_index WHERE path = ?", (path,)).fetchone()
+        else:
+            row = row[1:]
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            index = SDTIndex.from_bytes(row[2])
+            if index is not None:
+                self.n_hits += 1
+                # scans count their own sections
+                count_sections(len(index))
+                return index
+
+        self.n_misses += 1
+        index = index_sdt(sdt_path)
+
+        self.pending[path] = (path, stat.st_size, stat.st_mtime_ns, index.to_bytes())
+        if len(self.pending) >= self.commit_every:
+            self.commit()
+
+        return index
+
+    def get_table(self, sdt_path):
+        """
+        Cached drop-in for smart_file_undub.scan_section_table
+        """
+        with stage("index"):
+            return self.get(sdt_path)
+
+    def commit(self):
+        """
+        Writes the new indexes to the database
+        """
+        if not self.pending:
+            return
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO sdt_index (path, size, mtime_ns, data) VALUES (?, ?, ?, ?)",
+            list(self.pending.values())
+        )
+        self.connection.commit()
+        self.pending = {}
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
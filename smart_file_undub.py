@@ -7,218 +7,234 @@ The files must corrsepond across dubs and have the same number of audio sections
 Written by Matthew Tran (giantlightbulb@gmail.com) with substantial reference to AnonRunzes's
 sdt_demux.py
 """
-import struct
-import os
-
-def get_u32_le(buf, offset):
-    return struct.unpack("<I", buf[offset:offset+4])[0]
-
-extmap = {
-    0x00000001: ".genh",   # ADPCM -> GENH / ".sdx_0"
-    0x00000002: ".dmx",    # this container was found on Zone of the Enders HD Remaster
-    0x00000003: ".nrm",
-    0x00000004: ".pacb",   # has "PACB" magic not seen in any of the original versions the HD remaster was based on
-    0x00000005: ".dmx",    # ditto
-    0x00000006: ".bpx",    
-    0x0000000c: ".pac",    # XBOX version of MGS2 - MPEG2 video format
-    0x0000000d: ".pac",    # XBOX version of MGS2 - MPEG2 video format
-    0x0000000e: ".pss",    # PS2 version of MGS2 - MPEG2 video format
-    0x0000000f: ".ipu",    # PS2 version of MGS2 - MPEG2 video format
-    0x00000020: ".m2v",    # this container is present even on all versions of the HD remaster(PS3, XBOX360, PSVITA), regardless of format
-    0x00010001: ".sdx_1",
-    0x00010004: ".sub_en", # it's a made-up container, becuase in the executable of those Metal Gear Solid PS2 games there's no indication of a container used for these formats
-    0x00020001: ".sdx_2",
-    0x00020004: ".sub_fr", # ditto
-    0x00030001: ".msf",    # PS3 HD remaster audio format
-    0x00030004: ".sub_de", # ditto
-    0x00040001: ".xwma",   # XBOX360 HD remaster audio format
-    0x00040004: ".sub_it", # ditto
-    0x00050001: ".9tav",   # PSVITA HD remaster audio format
-    0x00050004: ".sub_es", # ditto
-    0x00060004: ".sub_jp", # ditto
-    0x00070004: ".sub_jp", # ditto
-    0x00100001: ".vag",    # VAG1/VAG2 format
-    0x00110001: ".mtaf",   # MTAF format
-
-    #0x00000002: ".xxxx",
-    #0x00000005: ".xxxx",
-    #0x00010006: ".xxxx",
-    #0x00020006: ".xxxx",
-    #0x00030006: ".xxxx",
-    #0x00040006: ".xxxx",
-    #0x00050006: ".xxxx",
-    #0x00070006: ".xxxx",
-}
-
-class Section:
+from psarc import PsarcMember, open_member
+from link_copy import copy_into
+from instrumentation import stage, count_read, count_written, count_sections
+# the .sdt format lives in sdt.py, these are re-exported for the scripts that import them from here
+from sdt import (
+    HEADER, U32_LE, get_u32_le, extmap, Section, SectionTable, MappedSDT,
+    decode_sections, scan_section_table, write_ranges, iterate_sections,
+    check_sdt_path, open_sdt, read_in_sections, chunk_sections, read_sdt_bytes, EXTENSION_CODES
+)
+
+SUPPORTED_FORMATS = [".vag", ".msf"] # audio formats copied across dubs
+SUPPORTED_EXTENSION_CODES = frozenset(EXTENSION_CODES[extension] for extension in SUPPORTED_FORMATS)
+
+STITCH_VERSION = 2 # bump whenever a change to the stitching changes the output bytes
+
+COPY_CHUNK_SIZE = 1024 * 1024 # bytes copied at a time when streaming sections between files
+
+def is_audio_only(sdt_path, index_cache=None):
     """
-    Section of a .sdt file
+    True if stitching this source .sdt over any target would reproduce it byte for byte:
+    a single registered .vag or .msf stream, and nothing after the end of file section.
+    Peeks at the registration headers at the start of the file and the last 16 bytes first, which rules out
+    most files cheaply. Streams can still be registered further into the file, so a file that passes the peek
+    is confirmed with a header-only walk (taken from index_cache, an sdt_index.SDTIndexCache, when one is given)
     """
-    def __init__(self, header, data):
-        self.header = header
-        self.data = data
-    
-    def get_header_id(self):
-        return get_u32_le(self.header, 0x00)
+    check_sdt_path(sdt_path)
+    if not peek_audio_only(sdt_path):
+        return False
     
-    def get_stream_id(self):
-        return get_u32_le(self.header, 0x0C)
-    
-    def get_size(self):
-        return get_u32_le(self.header, 0x04) - 16
-    
-    def get_extension(self):
-        if self.get_header_id() == 0x10:
-            stream_id = self.get_stream_id()
-        else:
-            stream_id = self.get_header_id()
-        
-        if stream_id in extmap.keys():
-            return extmap[stream_id]
-        else:
-            return ".bin"
-        
+    table = index_cache.get_table(sdt_path) if index_cache is not None else scan_section_table(sdt_path)
+    return len(table.streams) == 1 and table.header_ids[-1] == 0xF0 and table.offsets[-1] + 16 == table.sdt_size
 
-        
-        
-    
-    def to_bytes(self):
-        if self.data:
-            return self.header + self.data
+def peek_audio_only(sdt_path):
+    """
+    The cheap half of is_audio_only: a single .vag or .msf stream registered up front, audio data right after it,
+    and an end of file section as the last 16 bytes. False rules the file out, True still needs a full header walk
+    """
+    with stage("peek"):
+        sdt, sdt_size = open_sdt(sdt_path)
+        with sdt:
+            streams = []
+            header = sdt.read(16)
+            while len(header) == 16 and get_u32_le(header, 0x00) == 0x10:
+                streams.append(get_u32_le(header, 0x0C))
+                header = sdt.read(16)
+            count_read(16 * (len(streams) + 1))
+            
+            if not (len(streams) == 1 and extmap.get(streams[0]) in SUPPORTED_FORMATS):
+                return False
+            
+            # the first section after the registration must be audio data, and the file must end on the end of file section
+            if not (len(header) == 16 and get_u32_le(header, 0x00) == streams[0]):
+                return False
+            
+            sdt.seek(sdt_size - 16)
+            count_read(16)
+            return get_u32_le(sdt.read(16), 0x00) == 0xF0
+
+def copy_sdt_to(sdt_path, output_file):
+    """
+    Copies a whole .sdt into an open binary file, kernel side for files on disk.
+    Returns the number of bytes written
+    """
+    with stage("write"):
+        if isinstance(sdt_path, PsarcMember):
+            with open_member(sdt_path) as member:
+                n_written = 0
+                for data in iter(lambda: member.read(COPY_CHUNK_SIZE), b""):
+                    output_file.write(data)
+                    n_written += len(data)
         else:
-            return self.header
+            n_written = copy_into(sdt_path, output_file)
+        
+        count_read(n_written)
+        count_written(n_written)
+        return n_written
 
-def read_in_sections(sdt_path):
+def plan_stitch_ranges(source_table, target_table):
     """
-    Read in all of the sections for a .sdt file at some path
+    Works out the stitched file chunk by chunk from the SectionTables of both .sdt files.
+    Copies the source (Japanese) audio chunks over the target (US) audio chunks, keeping everything else from the target.
+    Currently manages .msf and .vag formatted sections.
+    Returns the stitched file as byte ranges (table, offset, length) of either file, where table is source_table
+    or target_table. Back to back ranges of the same file are merged
     """
-    sections = []
-
-    streams = [] # list of all registered streams
+    if not len(source_table) or not len(target_table):
+        raise Exception("Cannot stitch a .sdt without any sections")
 
-    if not os.path.isfile(sdt_path):
-        raise Exception(f"{sdt_path} Invalid path for the SDT file")
-    
-    if not os.path.splitext(sdt_path)[-1] == ".sdt":
-        raise Exception(f"{sdt_path} is not an SDT file!")
+    source_audio_chunks = [(start, end) for start, end in source_table.get_chunks() if source_table.is_chunk_in(start, SUPPORTED_EXTENSION_CODES)]
 
-    sdt_size = os.path.getsize(sdt_path)
+    if len(source_table.streams) == 1 and extmap[source_table.streams[0]] in SUPPORTED_FORMATS:
+        # audio only file, just copy the source data over the target
+        output_chunks = [(source_table, 0, len(source_table))]
+    else:
+        output_chunks = []
+        audio_chunk_index = 0
 
-    # open the sdt
-    with open(sdt_path, "rb") as sdt:
-        # iterate over all bytes in the file
-        while (sdt.tell() < sdt_size):
-            header = sdt.read(16)
-            header_id = get_u32_le(header, 0x00) # what type of header we have
-
-            if header_id == 0xF0:
-                # end of file header
-                end_section = Section(header, None)
-                sections.append(end_section)
-                break
-            elif header_id == 0x10:
-                # register a new stream
-                stream_id = get_u32_le(header, 0x0C)
-
-                # failure state,
-                if stream_id in streams:
-                    print("0x%08X: stream already registered once: %08X" % (sdt.tell() - 16, stream_id))
-                    exit()
+        for start, end in target_table.get_chunks():
+            if target_table.is_chunk_in(start, SUPPORTED_EXTENSION_CODES):
+                if audio_chunk_index >= len(source_audio_chunks):
+                    continue
+                
+                source_start, source_end = source_audio_chunks[audio_chunk_index]
+                if not target_table.extension_codes[start] == source_table.extension_codes[source_start]:
+                    raise Exception("Mismatch audio formats")
                 
-                streams.append(stream_id)
-
-                register_section = Section(header, None)
-                sections.append(register_section)
-            elif header_id in streams:
-                # read in header data section
-                size = get_u32_le(header, 0x04) - 16
-                data = sdt.read(size)
-
-                # add the stream data section to the list of sections
-                data_section = Section(header, data)
-                sections.append(data_section)
+                output_chunks.append((source_table, source_start, source_end))
+                audio_chunk_index += 1
             else:
-                print("0x%08X: unregistered stream / unknown header ID: %08X" % (sdt.tell() - 16, header_id))
-                exit()
-    
-    return sections, streams
-
-def chunk_sections(sections):
-    last_header_id = None
-    
-    chunks = []
-    chunk_data = []
-    
-    for section in sections:
-        header_id = section.get_header_id()
+                output_chunks.append((target_table, start, end))
         
-        if not header_id == last_header_id and last_header_id:
-            chunks.append(chunk_data)
-            chunk_data = []
-		
-        chunk_data.append(section)
-        
-        last_header_id = header_id
+        # catch extra japanese audio chunks at the end
+        for source_start, source_end in source_audio_chunks[audio_chunk_index:]:
+            output_chunks.append((source_table, source_start, source_end))
     
-    chunks.append(chunk_data)
+    ranges = []
+    for table, start, end in output_chunks:
+        offset, length = table.get_range(start, end)
+        if ranges:
+            last_table, last_offset, last_length = ranges[-1]
+            if last_table is table and last_offset + last_length == offset:
+                ranges[-1] = (table, last_offset, last_length + length)
+                continue
+        ranges.append((table, offset, length))
     
-    return chunks
+    return ranges
 
 def smart_stitch(source_sdt_path, target_sdt_path):
     """
     Intelligently stiches two .sdt files based on file sections.
     Currently manages .msf and .vag formatted sections
     """
-    supported_formats = [".vag", ".msf"]
+    # audio only files are copied over the target as they are
+    if is_audio_only(source_sdt_path):
+        check_sdt_path(target_sdt_path)
+        return read_sdt_bytes(source_sdt_path)
 
-    # read in all of the file sections
-    source_sections, source_streams = read_in_sections(source_sdt_path)
-    target_sections, target_streams = read_in_sections(target_sdt_path)
-    
-    # chunk the sections by header_id 
-    source_chunks = chunk_sections(source_sections)
-    target_chunks = chunk_sections(target_sections)
+    # read in both files whole
+    check_sdt_path(source_sdt_path)
+    source_data = read_sdt_bytes(source_sdt_path)
+    check_sdt_path(target_sdt_path)
+    target_data = read_sdt_bytes(target_sdt_path)
+
+    return smart_stitch_data(source_data, target_data)
+
+def smart_stitch_data(source_data, target_data):
+    """
+    smart_stitch on the bytes of both files, already read in whole. Returns the bytes of the stitched file
+    """
+    with stage("parse"):
+        source_table = decode_sections(source_data)
+        count_sections(len(source_table))
     
-    source_audio_chunks = [chunk for chunk in source_chunks if (chunk[0].get_extension() in supported_formats and (not chunk[0].get_header_id() == 0x10))]
+    with stage("parse"):
+        target_table = decode_sections(target_data)
+        count_sections(len(target_table))
     
-    if len(source_streams) == 1 and extmap[source_streams[0]] in supported_formats:
-        # audio only file, just copy the source data over the target
-        output_sections = source_sections
-    else:
-        output_sections = []
-        audio_chunk_index = 0
-        
-        # stitch the files together
-        for i in range(len(target_chunks)):
-            target_chunk = target_chunks[i]
-            # make sure we're not working with a header
-            if (target_chunk[0].get_extension() in supported_formats) and (not target_chunk[0].get_header_id() == 0x10):
-                # working with an audio chunk
-                if audio_chunk_index >= len(source_audio_chunks):
-                    continue
-                
-                # verify that the extensions are the same
-                if not target_chunk[0].get_extension() == source_audio_chunks[audio_chunk_index][0].get_extension():
-                    raise Exception("Mismatch audio formats")
+    with stage("plan"):
+        output_ranges = plan_stitch_ranges(source_table, target_table)
 
-                # add the Japanese audio chunk to the end
-                output_sections += source_audio_chunks[audio_chunk_index]
-                audio_chunk_index += 1
-                
-            else:
-                output_sections += target_chunk
+    with stage("join"):
+        # join the planned byte ranges of both files into a total data stream
+        buffers = {id(source_table): memoryview(source_data), id(target_table): memoryview(target_data)}
+        return b"".join([buffers[id(table)][offset:offset + length] for table, offset, length in output_ranges])
+
+def smart_stitch_to_file(source_sdt_path, target_sdt_path, output_file, chunk_size=COPY_CHUNK_SIZE, index_cache=None):
+    """
+    Streaming version of smart_stitch, writing the stitched file to an open binary file handle.
+    Only the section headers of both files are scanned to plan the stitch, then the planned byte
+    ranges are copied straight from the source and target files in chunks of at most chunk_size bytes,
+    so memory use does not depend on the size of the files.
+    The header scans are taken from index_cache (an sdt_index.SDTIndexCache) when one is given.
+    Returns the number of bytes written
+    """
+    if is_audio_only(source_sdt_path, index_cache):
+        check_sdt_path(target_sdt_path)
+        return copy_sdt_to(source_sdt_path, output_file)
+
+    if index_cache is not None:
+        scan = index_cache.get_table
+    else:
+        scan = scan_section_table
+
+    source_table = scan(source_sdt_path)
+    target_table = scan(target_sdt_path)
+
+    with stage("plan"):
+        copy_ranges = plan_stitch_ranges(source_table, target_table)
+
+    n_written = 0
+    with stage("write"):
+        source, source_size = open_sdt(source_sdt_path)
+        target, target_size = open_sdt(target_sdt_path)
+        with source, target:
+            sdt_files = {id(source_table): source, id(target_table): target}
+
+            for table, offset, length in copy_ranges:
+                sdt = sdt_files[id(table)]
+                sdt.seek(offset)
+                while length > 0:
+                    data = sdt.read(min(length, chunk_size))
+                    if not data:
+                        break
+                    output_file.write(data)
+                    n_written += len(data)
+                    length -= len(data)
         
-        # catch extra japanese audio chunks at the end
-        while audio_chunk_index < len(source_audio_chunks):
-            output_sections += source_audio_chunks[audio_chunk_index]
-            audio_chunk_index += 1
-    
+        count_read(n_written)
+        count_written(n_written)
 
-    # convert the sections back into bytes
-    output_byte_sections = [section.to_bytes() for section in output_sections]
+    return n_written
 
-    # join and return them as a total data stream
-    return b"".join(output_byte_sections)
+def smart_stitch_mapped(source_sdt_path, target_sdt_path, output_file):
+    """
+    Zero-copy version of smart_stitch, memory mapping both files and writing the
+    stitched sections to an open binary file handle straight from the mapped views.
+    Returns the number of bytes written
+    """
+    if is_audio_only(source_sdt_path):
+        check_sdt_path(target_sdt_path)
+        return copy_sdt_to(source_sdt_path, output_file)
+
+    with MappedSDT(source_sdt_path) as source, MappedSDT(target_sdt_path) as target:
+        with stage("plan"):
+            output_ranges = plan_stitch_ranges(source.table, target.table)
+        with stage("write"):
+            buffers = {id(source.table): source.buffer, id(target.table): target.buffer}
+            return write_ranges(output_file, [(buffers[id(table)], offset, length) for table, offset, length in output_ranges])
 
 def dumb_stitch(source_sdt_path, target_sdt_path):
     """
@@ -0,0 +1,210 @@
+"""
+Undub Plan
+
+Works out what an undub run would do to every file without doing it: which files are stitched, passed through
+(linked, copied or extracted), taken over whole from the Japanese version or skipped as unchanged, how many chunks
+and audio chunks the stitched files have, how big every output file will be, and which files will fail.
+Only section headers are read (and the registration headers of audio only files), never any payload, so a plan
+of the whole tree takes a fraction of the time of the run itself. The plan is written as JSON.
+"""
+import os
+import time
+from psarc import PsarcMember, get_archive
+from link_copy import save_json
+from smart_file_undub import is_audio_only, check_sdt_path, scan_section_table, plan_stitch_ranges, SUPPORTED_EXTENSION_CODES
+
+PLAN_VERSION = 1
+
+def get_input_size(input_file):
+    """
+    Size of an input file, or of a file inside an archive (psarc.PsarcMember) once extracted
+    """
+    if isinstance(input_file, PsarcMember):
+        return get_archive(input_file.archive_path).get_entry(input_file.name).size
+    return os.path.getsize(input_file)
+
+def get_device(path):
+    """
+    Device of the closest existing folder of path, as the output folders may not exist yet
+    """
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return os.stat(path).st_dev
+
+def predict_place_method(source_file, output_file, link_mode="auto"):
+    """
+    How main.place_file would put a file into the output: "extract" for files inside archives, "copy" when no link
+    can be made across devices, otherwise the link mode. The auto mode tries a reflink before a hardlink, and only
+    trying tells whether the filesystem can make one, so it is predicted as "reflink or hardlink".
+    Raises an OSError when a forced reflink or hardlink would fail across devices, as link_copy.link_or_copy does
+    """
+    if isinstance(source_file, PsarcMember):
+        return "extract"
+    if link_mode == "copy":
+        return "copy"
+    if not get_device(source_file) == get_device(os.path.dirname(output_file)):
+        if not link_mode == "auto":
+            raise OSError(f"cannot {link_mode} {source_file} across devices")
+        return "copy"
+    if link_mode == "auto":
+        return "reflink or hardlink"
+    return link_mode
+
+def get_audio_chunks(table):
+    """
+    Extensions of the audio chunks of a SectionTable, in order
+    """
+    return [table.get_extension(start) for start, end in table.get_chunks() if table.is_chunk_in(start, SUPPORTED_EXTENSION_CODES)]
+
+def describe_error(error):
+    if isinstance(error, SystemExit):
+        # the SDT parsers print what is wrong and exit()
+        return "malformed .sdt"
+    return str(error)
+
+def new_entry(japanese_file, us_file, output_file, action=None):
+    return {
+        "file": str(us_file),
+        "japanese_file": None if japanese_file is None else str(japanese_file),
+        "output_file": output_file,
+        "action": action,
+        "method": None,
+        "input_size": None,
+        "expected_size": None,
+        "warnings": [],
+        "error": None,
+    }
+
+def plan_file(japanese_file, us_file, output_file, link_mode="auto", index_cache=None):
+    """
+    Plans a single (japanese_file, us_file, output_file) work item, following the same rules as main.undub_file.
+    The section tables are taken from index_cache (an sdt_index.SDTIndexCache) when one is given.
+    Never raises: a file that would fail gets the "fail" action and the error it would fail with
+    """
+    entry = new_entry(japanese_file, us_file, output_file)
+
+    try:
+        entry["input_size"] = get_input_size(us_file)
+
+        if japanese_file is None:
+            entry["action"] = "pass through"
+            entry["method"] = predict_place_method(us_file, output_file, link_mode)
+            entry["expected_size"] = entry["input_size"]
+            return entry
+
+        if is_audio_only(japanese_file, index_cache):
+            check_sdt_path(us_file)
+            entry["action"] = "audio only"
+            entry["method"] = predict_place_method(japanese_file, output_file, link_mode)
+            entry["expected_size"] = get_input_size(japanese_file)
+            return entry
+
+        scan = index_cache.get_table if index_cache is not None else scan_section_table
+        source_table = scan(japanese_file)
+        target_table = scan(us_file)
+
+        us_audio_chunks = get_audio_chunks(target_table)
+        japanese_audio_chunks = get_audio_chunks(source_table)
+        entry["n_chunks"] = len(target_table.get_chunks())
+        entry["n_sections"] = len(target_table)
+        entry["n_us_audio_chunks"] = len(us_audio_chunks)
+        entry["n_japanese_audio_chunks"] = len(japanese_audio_chunks)
+        entry["audio_formats"] = sorted(set(us_audio_chunks))
+
+        # surplus chunks do not fail the stitch, but the output will not line up with the US file
+        if len(japanese_audio_chunks) < len(us_audio_chunks):
+            entry["warnings"].append(f"{len(us_audio_chunks) - len(japanese_audio_chunks)} US audio chunks without a Japanese equivalent are dropped")
+        elif len(japanese_audio_chunks) > len(us_audio_chunks):
+            entry["warnings"].append(f"{len(japanese_audio_chunks) - len(us_audio_chunks)} extra Japanese audio chunks are appended")
+
+        ranges = plan_stitch_ranges(source_table, target_table)
+        entry["action"] = "stitch"
+        entry["expected_size"] = sum(length for table, offset, length in ranges)
+    except (Exception, SystemExit) as error:
+        entry["action"] = "fail"
+        entry["error"] = describe_error(error)
+
+    return entry
+
+class UndubPlan:
+    """
+    Planned action of every file of a run, see plan_file
+    """
+    def __init__(self, stitch_mode="memory"):
+        self.start = time.perf_counter()
+        self.stitch_mode = stitch_mode
+        self.files = []
+
+    def add_file(self, entry, stitch_mode=None):
+        """
+        Adds the entry of a planned file (see plan_file), stitched in stitch_mode (by default the stitch mode of the run)
+        """
+        if entry["action"] == "stitch":
+            entry["method"] = stitch_mode or self.stitch_mode
+        self.files.append(entry)
+
+    def add_missing_file(self, input_file, output_file, error="not found in Japanese files"):
+        """
+        Adds a file without an equivalent in the other version, which fails before any work is done
+        """
+        entry = new_entry(None, input_file, output_file, "fail")
+        entry["input_size"] = get_input_size(input_file)
+        entry["error"] = error
+        self.files.append(entry)
+
+    def add_warning(self, output_file, warning):
+        """
+        Adds a warning to the entry of the planned file written to output_file
+        """
+        for entry in self.files:
+            if entry["output_file"] == output_file:
+                entry["warnings"].append(warning)
+
+    def add_skipped_file(self, japanese_file, us_file, output_file):
+        """
+        Adds a file that an incremental run skips, as it is unchanged since it was last written
+        """
+        entry = new_entry(japanese_file, us_file, output_file, "skip")
+        entry["expected_size"] = os.path.getsize(output_file)
+        self.files.append(entry)
+
+    def get_actions(self):
+        actions = {}
+        for entry in self.files:
+            action = entry["action"] if entry["method"] is None else f"{entry['action']} ({entry['method']})"
+            actions[action] = actions.get(action, 0) + 1
+        return actions
+
+    def get_failures(self):
+        return [entry for entry in self.files if entry["action"] == "fail"]
+
+    def to_dict(self):
+        return {
+            "version": PLAN_VERSION,
+            "seconds": time.perf_counter() - self.start,
+            "n_files": len(self.files),
+            "actions": self.get_actions(),
+            "n_predicted_failures": len(self.get_failures()),
+            "n_warnings": sum(len(entry["warnings"]) for entry in self.files),
+            "input_bytes": sum(entry["input_size"] or 0 for entry in self.files),
+            "expected_output_bytes": sum(entry["expected_size"] or 0 for entry in self.files),
+            "files": self.files,
+        }
+
+    def print_summary(self):
+        print(f"Planned {len(self.files)} files in {time.perf_counter() - self.start:.2f}s")
+        for action, n in sorted(self.get_actions().items()):
+            print(f"\t{action}: {n}")
+
+        for entry in self.files:
+            for warning in entry["warnings"]:
+                print(f"\tWarning: {entry['file']}: {warning}")
+        for entry in self.get_failures():
+            print(f"\tWill fail: {entry['file']}: {entry['error']}")
+
+    def save(self, plan_path):
+        save_json(plan_path, self.to_dict(), indent=1)
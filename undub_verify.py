@@ -0,0 +1,105 @@
+"""
+Undub Verification
+
+Checks an output tree after a run, without booting the game: every stitched .sdt is re-scanned header by header
+(payloads are never read) to check that it is well formed (see sdt.verify_section_table), then cross-checked against
+the section tables of its inputs: it must have the same audio chunks, in the same formats, as the Japanese source,
+and exactly the size the stitch plan of the inputs adds up to. Files that were passed through must be there,
+as big as their input. The results are written as JSON.
+"""
+import os
+import time
+from sdt import verify_section_table
+from link_copy import save_json
+from smart_file_undub import is_audio_only, scan_section_table, plan_stitch_ranges
+from undub_plan import get_input_size, get_audio_chunks
+
+VERIFY_VERSION = 1
+
+def verify_file(japanese_file, us_file, output_file, index_cache=None):
+    """
+    Verifies the output of a single (japanese_file, us_file, output_file) work item, a japanese_file of None meaning
+    the US file was passed through. The section tables of the inputs are taken from index_cache (an sdt_index.SDTIndexCache)
+    when one is given. Never raises: returns the result of the file, with every problem found
+    """
+    result = {
+        "file": output_file,
+        "us_file": str(us_file),
+        "japanese_file": None if japanese_file is None else str(japanese_file),
+        "size": None,
+        "expected_size": None,
+        "problems": [],
+    }
+    problems = result["problems"]
+
+    try:
+        if not os.path.isfile(output_file):
+            problems.append("missing from the output")
+            return result
+        result["size"] = os.path.getsize(output_file)
+
+        if japanese_file is None:
+            result["expected_size"] = get_input_size(us_file)
+        else:
+            output_table, output_problems = verify_section_table(output_file)
+            problems += output_problems
+
+            scan = index_cache.get_table if index_cache is not None else scan_section_table
+            source_table = scan(japanese_file)
+            if is_audio_only(japanese_file, index_cache):
+                result["expected_size"] = get_input_size(japanese_file)
+            else:
+                result["expected_size"] = sum(length for table, offset, length in plan_stitch_ranges(source_table, scan(us_file)))
+
+            audio_chunks = get_audio_chunks(output_table)
+            expected_audio_chunks = get_audio_chunks(source_table)
+            result["n_sections"] = len(output_table)
+            result["n_audio_chunks"] = len(audio_chunks)
+            result["n_expected_audio_chunks"] = len(expected_audio_chunks)
+            if not len(audio_chunks) == len(expected_audio_chunks):
+                problems.append(f"{len(audio_chunks)} audio chunks, the Japanese source has {len(expected_audio_chunks)}")
+            elif not audio_chunks == expected_audio_chunks:
+                problems.append(f"audio chunk formats {' '.join(audio_chunks)} do not match the Japanese source ({' '.join(expected_audio_chunks)})")
+
+        if not result["size"] == result["expected_size"]:
+            problems.append(f"{result['size']} bytes, {result['expected_size']} expected")
+    except (Exception, SystemExit) as error:
+        # the inputs themselves are malformed (the SDT parsers exit() on them), so the output cannot be checked
+        problems.append(f"unable to verify: {error if isinstance(error, Exception) else 'malformed input .sdt'}")
+
+    return result
+
+class UndubVerification:
+    """
+    Verification results of every file of an output tree, see verify_file
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.files = []
+
+    def add_file(self, result):
+        self.files.append(result)
+
+    def get_failures(self):
+        return [result for result in self.files if result["problems"]]
+
+    def to_dict(self):
+        return {
+            "version": VERIFY_VERSION,
+            "seconds": time.perf_counter() - self.start,
+            "n_files": len(self.files),
+            "n_failed": len(self.get_failures()),
+            "failed": sorted(result["file"] for result in self.get_failures()),
+            "files": sorted(self.files, key=lambda result: result["file"]),
+        }
+
+    def print_summary(self):
+        failures = self.get_failures()
+        for result in sorted(failures, key=lambda result: result["file"]):
+            print(f"{result['file']}:")
+            for problem in result["problems"]:
+                print(f"\t{problem}")
+        print(f"Verified {len(self.files)} files in {time.perf_counter() - self.start:.2f}s, {len(failures)} failed")
+
+    def save(self, report_path):
+        save_json(report_path, self.to_dict(), indent=1)